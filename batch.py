@@ -0,0 +1,79 @@
+import time
+
+import decide
+import problems
+import storage
+import theories
+
+# This file runs many decisions in one go, given as a list of jobs. Each job is a tuple
+# (theory, problem, observations) naming a decision theory from theories.THEORIES and a
+# decision problem from problems.PROBLEMS, with observations either None, to use the
+# problem's own observations, or a dict to use instead.
+#
+# Each problem is built once and shared by every job that uses it. Theories leave most
+# of the factors of the world model untouched, and tabulated factors are cached on the
+# factors themselves, so jobs whose modified graphs overlap share that work. Jobs that
+# reach the same decision share the result through decide()'s own cache.
+
+
+def run(jobs, backend="enumeration", cache_dir=None, **options):
+    """
+    Run a list of (theory, problem, observations) jobs and return one row per job. Each
+    row is a dict giving the job, the output chosen, and the time taken in seconds. A job
+    that fails does not stop the others; its output is the error message instead. With a
+    CACHE_DIR, problems are loaded from there if they were saved by an earlier run (see
+    storage.py).
+    """
+    built = {}
+    rows = []
+    for theory_name, problem_name, observations in jobs:
+        start = time.perf_counter()
+        if problem_name not in built:
+            built[problem_name] = build(problem_name, cache_dir)
+        world_model, problem_observations, utility_node, physical_identity, logical_identity = built[problem_name]
+        if observations is None:
+            observations = problem_observations
+        try:
+            _, output = decide.decide(theories.THEORIES[theory_name], world_model, observations,
+                                      utility_node, physical_identity, logical_identity,
+                                      backend=backend, **options)
+        except Exception as e:
+            output = f"error: {e}"
+        rows.append({
+            "theory": theory_name,
+            "problem": problem_name,
+            "observations": observations,
+            "output": output,
+            "seconds": time.perf_counter() - start,
+        })
+    return rows
+
+
+def build(problem_name, cache_dir=None):
+    """
+    Build the decision problem called PROBLEM_NAME in problems.PROBLEMS, loading it from
+    CACHE_DIR instead if it was saved there before (see storage.cached). With no cache
+    directory, it is always built.
+    """
+    if cache_dir is None:
+        return problems.PROBLEMS[problem_name]()
+    return storage.cached(problems.PROBLEMS[problem_name], directory=cache_dir)
+
+
+def all_jobs():
+    """
+    Every decision theory on every decision problem, with the problem's own observations.
+    """
+    return [(theory, problem, None) for theory in theories.THEORIES for problem in problems.PROBLEMS]
+
+
+def format_table(rows):
+    """
+    Lay out the rows returned by run() as a plain-text table.
+    """
+    columns = ["theory", "problem", "observations", "output", "seconds"]
+    cells = [[f"{row[c]:.4f}" if c == "seconds" else str(row[c]) for c in columns] for row in rows]
+    widths = [max([len(c)] + [len(line[i]) for line in cells]) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.extend("  ".join(cell.ljust(w) for cell, w in zip(line, widths)) for line in cells)
+    return "\n".join(lines)
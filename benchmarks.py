@@ -0,0 +1,327 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import decide
+import inference
+import problems
+import profiling
+import theories
+from factorgraph import Factor, FactorGraph
+
+# This file measures how the decision theories and inference backends scale. It contains
+# generators for decision problems of any size, and a runner that times every theory
+# under every backend on each problem at growing sizes, and writes the results as JSON so
+# that they can be compared between commits.
+
+
+def build_noisy_newcomb(num_predictors, accuracy):
+    """
+    Set up a version of Newcomb's problem in which NUM_PREDICTORS predictors each run a
+    simulation of my decision algorithm, and each reports the outcome of their simulation
+    correctly with probability ACCURACY. Omega fills the first box if a majority of the
+    predictors predict that I will 1-box.
+
+    Each simulation is a logical copy of my decision, whereas each prediction is only a
+    noisy report of a simulation.
+    """
+    simulations = [f"simulation {i}" for i in range(num_predictors)]
+    predictions = [f"prediction {i}" for i in range(num_predictors)]
+
+    # first set up the names of the nodes and their possible values
+    nodes = {
+        "my inclination":           ["1-box", "2-box"],
+        "which boxes I take":       ["1-box", "2-box"],
+    }
+    for simulation, prediction in zip(simulations, predictions):
+        nodes[simulation] = ["1-box", "2-box"]
+        nodes[prediction] = ["1-box", "2-box"]
+    nodes["contents of first box"] = [1000000, 0]
+    nodes["money I walk away with"] = [0, 1000, 1000000, 1001000]
+
+    # now set up the factors defining the relationship between the different nodes
+    factors = [
+        Factor.uniform("my inclination", 0.5),
+        Factor.identical("which boxes I take", "my inclination"),
+    ]
+    for simulation, prediction in zip(simulations, predictions):
+        factors.append(Factor.identical(simulation, "my inclination"))
+        factors.append(Factor(prediction, [simulation],
+                              lambda prediction, simulation: accuracy if prediction == simulation else 1 - accuracy))
+    factors.append(Factor.deterministic(
+        "contents of first box", predictions,
+        lambda *predictions: 1000000 if 2 * predictions.count("1-box") > len(predictions) else 0))
+    factors.append(Factor.deterministic(
+        "money I walk away with", ["contents of first box", "which boxes I take"],
+        lambda first_box_contents, decision: first_box_contents if decision == "1-box" else first_box_contents + 1000))
+
+    # there are no observations, and my decision algorithm determines my own choice as
+    # well as the outcome of every simulation
+    world_model = FactorGraph(nodes, factors)
+    return world_model, {}, "money I walk away with", "which boxes I take", ["which boxes I take"] + simulations
+
+
+def build_rooms(num_copies, num_colors):
+    """
+    Set up the red room / blue room problem with NUM_COPIES copies of the agent and rooms
+    of NUM_COLORS different colors. See problems.build_many_rooms.
+    """
+    colors = [f"color {i}" for i in range(num_colors)]
+    return problems.build_many_rooms(num_copies, colors[0], colors)
+
+
+def build_chain(num_stages, accuracy=0.9):
+    """
+    Set up a problem in which I make NUM_STAGES decisions one after another. A switch
+    starts out either low or high, and at each stage I take a reading of the switch that
+    is correct with probability ACCURACY, and then either leave the switch alone or flip
+    it. I receive a reward if the switch is high at the end. I observe only the first
+    reading, and the same decision algorithm makes the decision at every stage.
+    """
+    states = [f"state {i}" for i in range(num_stages + 1)]
+    readings = [f"reading {i}" for i in range(num_stages)]
+    actions = [f"action {i}" for i in range(num_stages)]
+
+    # first set up the names of the nodes and their possible values
+    nodes = {states[0]: ["low", "high"]}
+    for reading, action, state in zip(readings, actions, states[1:]):
+        nodes[reading] = ["low", "high"]
+        nodes[action] = ["leave", "flip"]
+        nodes[state] = ["low", "high"]
+    nodes["utility"] = [0, 1]
+
+    # now set up the factors defining the relationship between the different nodes
+    factors = [Factor.uniform(states[0], 0.5)]
+    for before, reading, action, after in zip(states, readings, actions, states[1:]):
+        factors.append(Factor(reading, [before],
+                              lambda reading, state: accuracy if reading == state else 1 - accuracy))
+        factors.append(Factor.uniform_function_of(action, [reading], 0.5))
+        factors.append(Factor.deterministic(
+            after, [before, action],
+            lambda state, action: state if action == "leave" else {"low": "high", "high": "low"}[state]))
+    factors.append(Factor.deterministic("utility", [states[-1]], lambda state: int(state == "high")))
+
+    world_model = FactorGraph(nodes, factors)
+    return world_model, {readings[0]: "low"}, "utility", actions[0], actions
+
+
+def build_ring(num_colors):
+    """
+    Set up a problem in which NUM_COLORS colors are arranged in a ring. I am placed in a
+    room of a color chosen uniformly at random, and a copy of me is placed in a room of
+    the next color around the ring. Each of us outputs one of two possible messages, and I
+    receive a reward if we choose differently. I observe the color of my own room.
+
+    A policy has one input for each color, but each possible world consults only two of
+    them, so this is the kind of problem where UDT1.1 can search dozens of inputs.
+    """
+    colors = [f"color {i}" for i in range(num_colors)]
+    following = dict(zip(colors, colors[1:] + colors[:1]))
+
+    # first set up the names of the nodes and their possible values
+    nodes = {
+        "color I see":          colors,
+        "action I take":        [1, 2],
+        "color my copy sees":   colors,
+        "action my copy takes": [1, 2],
+        "utility":              [0, 1],
+    }
+
+    # now set up the factors defining the relationship between the different nodes
+    factors = [
+        Factor.uniform("color I see", 1 / num_colors),
+        Factor.deterministic("color my copy sees", ["color I see"], lambda color: following[color]),
+        Factor.uniform_function_of("action I take", ["color I see"], 0.5),
+        Factor.uniform_function_of("action my copy takes", ["color my copy sees"], 0.5),
+        Factor.deterministic("utility", ["action I take", "action my copy takes"],
+                             lambda mine, theirs: int(mine != theirs)),
+    ]
+
+    world_model = FactorGraph(nodes, factors)
+    return (world_model, {"color I see": colors[0]}, "utility", "action I take",
+            ["action I take", "action my copy takes"])
+
+
+# the problem generators, together with the sizes at which to run each one
+GENERATORS = {
+    "newcomb": (lambda size: build_noisy_newcomb(size, 0.9), [1, 2, 3, 4, 6, 8, 10, 12, 16]),
+    "rooms": (lambda size: build_rooms(size, 3), [2, 3, 4, 5, 6, 8, 12, 16, 20]),
+    "chain": (build_chain, [1, 2, 3, 4, 5, 6, 8, 12, 16, 24, 32]),
+    "ring": (build_ring, [2, 3, 4, 6, 8, 12, 16, 24, 32, 48]),
+}
+
+
+def measure(theory_name, generator, size, backend):
+    """
+    Run one decision from scratch and return a dict giving the output chosen, the wall time
+    in seconds, the peak memory allocated in bytes, and the number of possible worlds
+    evaluated. Memory and worlds are measured in a second run, since tracing allocations
+    and profiling slow the program down.
+    """
+    result = {}
+    for trace in [False, True]:
+        # start from empty caches, and from a freshly built problem with no cached tables
+        decide.reset_caches()
+        inference.reset_caches()
+        world_model, observations, utility_node, physical_identity, logical_identity = generator(size)
+
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with profiling.profiled() if trace else contextlib.nullcontext() as profile:
+                _, output = decide.decide(theories.THEORIES[theory_name], world_model, observations, utility_node,
+                                          physical_identity, logical_identity, backend=backend)
+        finally:
+            seconds = time.perf_counter() - start
+            if trace:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+        if trace:
+            result["peak_bytes"] = peak
+            result["worlds_evaluated"] = profile.worlds_generated
+        else:
+            result["output"] = repr(output)
+            result["seconds"] = seconds
+    return result
+
+
+def run(generators, theory_names, backends, max_seconds):
+    """
+    Measure every theory under every backend on every problem, at each size in turn. We
+    stop growing a problem for a given theory and backend once a run takes more than
+    MAX_SECONDS or fails. Returns one dict per run.
+    """
+    results = []
+    for problem_name in generators:
+        generator, sizes = GENERATORS[problem_name]
+        for theory_name in theory_names:
+            for backend in backends:
+                for size in sizes:
+                    row = {"problem": problem_name, "size": size, "theory": theory_name, "backend": backend}
+                    try:
+                        row.update(measure(theory_name, generator, size, backend))
+                    except Exception as e:
+                        row["error"] = str(e)
+                    results.append(row)
+                    if "error" in row:
+                        print(f"{problem_name} {size} {theory_name} {backend}: error: {row['error']}", file=sys.stderr)
+                        break
+                    print(f"{problem_name} {size} {theory_name} {backend}: {row['seconds']:.4f}s "
+                          f"{row['peak_bytes']} bytes {row['worlds_evaluated']} worlds", file=sys.stderr)
+                    if row["seconds"] > max_seconds:
+                        break
+    return results
+
+
+# modules that running a decision from the command line should not need to import
+HEAVY_MODULES = ["pandas", "graphviz", "PIL", "asyncio"]
+
+
+def import_time(module="main", repeats=5):
+    """
+    Measure how long a fresh interpreter takes to import MODULE, using python -X importtime.
+    Returns a dict giving the fastest of REPEATS runs in seconds, together with any of the
+    HEAVY_MODULES that were imported along the way.
+    """
+    fastest = None
+    for _ in range(repeats):
+        # run next to this file, so that MODULE is found wherever we were started from
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                 capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        imported = {}
+        for line in process.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulative, name = line.split("|")
+                if cumulative.strip().isdigit():
+                    imported[name.strip()] = int(cumulative) / 1e6
+        fastest = imported[module] if fastest is None else min(fastest, imported[module])
+    heavy = [name for name in imported if name in HEAVY_MODULES]
+    return {"module": module, "seconds": fastest, "heavy_modules": heavy}
+
+
+def compare(before, after, import_threshold=1.25):
+    """
+    Print the ratio of the time taken in AFTER to the time taken in BEFORE for every run
+    that appears in both, which are results in the format written by main(). Returns a list
+    of regressions: the import taking more than IMPORT_THRESHOLD times as long as before,
+    and any of the HEAVY_MODULES that are imported now but were not before.
+    """
+    def key(row):
+        return row["problem"], row["size"], row["theory"], row["backend"]
+
+    earlier = {key(row): row for row in before["results"] if "seconds" in row}
+    for row in after["results"]:
+        if "seconds" in row and key(row) in earlier:
+            ratio = row["seconds"] / earlier[key(row)]["seconds"]
+            print(f"{' '.join(map(str, key(row)))}: {ratio:.2f}x time")
+
+    regressions = []
+    if "import" in before and "import" in after:
+        module = after["import"]["module"]
+        ratio = after["import"]["seconds"] / before["import"]["seconds"]
+        print(f"import {module}: {ratio:.2f}x time")
+        if ratio > import_threshold:
+            regressions.append(f"import {module} takes {ratio:.2f}x as long as before")
+        for name in after["import"]["heavy_modules"]:
+            if name not in before["import"]["heavy_modules"]:
+                regressions.append(f"import {module} now imports {name}")
+    return regressions
+
+
+def commit():
+    """
+    The hash of the git commit that is checked out, or None if it cannot be determined.
+    """
+    try:
+        process = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True)
+    except OSError:
+        return None
+    return process.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problems", nargs="+", choices=list(GENERATORS), default=list(GENERATORS))
+    parser.add_argument("--theories", nargs="+", choices=list(theories.THEORIES), default=list(theories.THEORIES))
+    parser.add_argument("--backends", nargs="+", choices=list(inference.BACKENDS), default=list(inference.BACKENDS))
+    parser.add_argument("--max_seconds", type=float, default=1.,
+                        help="stop growing a problem once a run takes longer than this")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="results from an earlier run to compare against")
+    parser.add_argument("--import_threshold", type=float, default=1.25,
+                        help="flag the import of main as a regression if it takes this many times as long as "
+                             "in the earlier run")
+    args = parser.parse_args()
+
+    results = {
+        "commit": commit(),
+        "python": sys.version,
+        "import": import_time(),
+        "results": run(args.problems, args.theories, args.backends, args.max_seconds),
+    }
+    print(f"import main: {results['import']['seconds']:.4f}s", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.import_threshold)
+    else:
+        # with nothing to compare against, any heavy module on the import path is a regression
+        regressions = [f"import main imports {name}" for name in results["import"]["heavy_modules"]]
+    for regression in regressions:
+        print(f"REGRESSION: {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,385 @@
-import pandas as pd
+import hashlib
 import itertools
 
-def decide(theory, world_model, observations, utility_node, physical_identity, logical_identity, args=None):
+import numpy as np
+
+import inference
+import profiling
+from factorgraph import conditionalize, relevant_subgraph
+
+# results of previous calls to decide(), keyed by a fingerprint of the arguments. Each is
+# a list of (reached, outcome) pairs, where REACHED is the set of fingerprints of every
+# call that the call led to, directly or indirectly, and OUTCOME is the output chosen,
+# that output passed through the theory's output formatter, and its expected utility, or
+# None if no output was consistent with itself. A call that leads back to a call in
+# progress is answered with the output assumed for it, so a result is only reused while
+# none of the calls it led to are in progress
+_results = {}
+
+# the outcomes of single attempts at calls in progress, keyed like _results, as lists of
+# (reached, assumed, outcome) triples, where ASSUMED maps the calls among REACHED that were
+# in progress at the time to the output that was assumed for them
+_attempts = {}
+
+# the fingerprints of the calls to decide() that are currently in progress, outermost
+# first, together with the output and formatted output that we are currently assuming for
+# each of them in case a call leads back to it, and the arguments of each
+_in_progress = {}
+_calls = {}
+
+# the fingerprints of the calls in progress whose surgery and inference are currently
+# being done, outermost first, and for each of them, the fingerprints of every call it
+# has led to so far, directly or indirectly
+_attempting = []
+_reached = {}
+
+# for each call in progress that leads back to itself, the other calls in progress that
+# lead back to it and whose outputs it is solving for together with its own, and for each
+# of those, the call solving for it
+_members = {}
+_root = {}
+
+
+class ObservationRequired(Exception):
+    """
+    Raised by a decision theory whose surgery cannot be done unless certain nodes are
+    observed, as opposed to a theory that fails for any other reason.
+    """
+
+
+# the theories that decide() has been called with, by id. Fingerprints identify a theory
+# by its id, and keeping a reference here means that id never passes to another object
+_theories = {}
+
+
+def reset_caches(make_cache=dict):
+    """
+    Forget every result and attempt remembered by decide(), and remember later ones in new
+    caches made by calling MAKE_CACHE, which may return any mapping with the same methods
+    as a dict, such as one that holds a limited number of entries.
+    """
+    global _results, _attempts
+    _results = make_cache()
+    _attempts = make_cache()
+
+
+def decide(theory, world_model, observations, utility_node, physical_identity, logical_identity, args=None,
+           backend="enumeration", prune=False, **options):
+    """
+    Use a decision theory to choose an action in a decision problem. Returns the value
+    chosen for the intervention node together with that value passed through the theory's
+    output formatter.
+
+    Results are remembered for the rest of the process, so asking the same question twice
+    does not repeat the work. A decision theory may call decide() on counterfactual versions
+    of its own problem (see decide_counterfactual), and those calls may in turn lead back to
+    a call that is already in progress. When that happens we cannot know the answer yet,
+    so the inner call is answered with an assumed output. The outermost call that is led
+    back to then solves for its own output and the outputs of every call in between
+    together, by fixed-point iteration (see _solve), so that each of them is the output
+    its own call chooses when all the others are assumed. Each attempt at a call is
+    remembered together with the outputs it assumed, so the cost grows with the number of
+    distinct counterfactual decisions times the number of rounds of iteration.
+
+    A result is only reused when none of the calls it led to is in progress, since each
+    of those would now be answered with an assumed output instead. The answer to a
+    question therefore does not depend on which questions were asked before it.
+
+    With PRUNE, nodes that cannot affect the expected utility are removed from the modified
+    graph before inference, which gives the same result with a smaller state space. For
+    that reason it is not part of the fingerprint, so a pruned call and an unpruned call
+    with the same arguments share a result and are recognized as the same call when one
+    leads back to the other.
+    """
+    key = fingerprint(theory, world_model, observations, utility_node, physical_identity, logical_identity,
+                      backend, options)
+    caller = _attempting[-1] if _attempting else None
+    if key not in _in_progress:
+        found = next((entry for entry in _results.get(key, ()) if entry[0].isdisjoint(_in_progress)), None)
+        if found is None:
+            _calls[key] = (theory, world_model, observations, utility_node, physical_identity, logical_identity,
+                           args, backend, prune, options)
+            found = _resolve(key)
+        reached, outcome = found
+        if caller is not None:
+            _reached[caller].update(reached)
+        if key not in _in_progress:
+            if outcome is None:
+                raise Exception(f"no self-consistent decision among {world_model.nodes[logical_identity[0]]}")
+            return outcome[:2]
+
+    # this call is in progress further out, so the caller relies on what we assume for it
+    if caller is not None:
+        _reached[caller].add(key)
+    return _in_progress[key]
+
+
+def decide_counterfactual(theory, world_model, observations, utility_node, physical_identity, logical_identity):
+    """
+    Call decide() from within a theory's surgery, with the same backend and backend
+    options as the call to decide() that is performing the surgery. A counterfactual
+    decision is then reached in the same way as the decision that asked for it, and is
+    recognized as the same call when it leads back to it.
+    """
+    settings = {}
+    if _attempting:
+        *_, backend, prune, options = _calls[_attempting[-1]]
+        settings = dict(options, backend=backend, prune=prune)
+    return decide(theory, world_model, observations, utility_node, physical_identity, logical_identity, **settings)
+
+
+def _resolve(key):
+    """
+    Work out the result of the call with fingerprint KEY, which is not in progress and has
+    no result that can be reused, and remember it. If the call turns out to lead back to a
+    call further out, it is left in progress for that call to solve for instead. Returns
+    the set of calls it led to and its outcome, as stored in _results.
+    """
+    candidates = _candidates(key)
+    _in_progress[key] = (candidates[0], candidates[0])
+    _members[key] = []
+    joined = False
+    try:
+        reached, outcome = _attempt(key)
+        if _outer(key, reached) is None and (key in reached or _members[key]):
+            reached, outcome = _solve(key, reached)
+        root = _outer(key, reached)
+        if root is not None:
+            if outcome is not None:
+                _in_progress[key] = (outcome[1], outcome[1])
+            for n in [key] + _members.pop(key):
+                _root[n] = root
+                _members[root].append(n)
+            joined = True
+            return frozenset(reached), outcome
+    finally:
+        if not joined:
+            for n in [key] + _members.pop(key, []):
+                del _in_progress[n]
+                del _calls[n]
+                _root.pop(n, None)
+
+    reached = frozenset(reached) - {key}
+    _results[key] = _results.get(key, []) + [(reached, outcome)]
+    return reached, outcome
+
+
+def _attempt(key):
+    """
+    Do the surgery and inference for the call in progress with fingerprint KEY once, with
+    every call in progress answered by the output assumed for it. Returns the set of calls
+    it led to and its outcome. Attempts are remembered together with the outputs they
+    assumed, and reused whenever the same outputs are assumed again.
+    """
+    for reached, assumed, outcome in _attempts.get(key, ()):
+        if (all((n in _in_progress) == (n in assumed) for n in reached)
+                and all(_in_progress[n][0] == output for n, output in assumed.items())):
+            return reached, outcome
+
+    _attempting.append(key)
+    _reached[key] = set()
+    try:
+        *arguments, options = _calls[key]
+        outcome = _decide(*arguments, **options)
+    finally:
+        _attempting.pop()
+        reached = frozenset(_reached.pop(key))
+    assumed = {n: _in_progress[n][0] for n in reached if n in _in_progress}
+    _attempts[key] = _attempts.get(key, []) + [(reached, assumed, outcome)]
+    return reached, outcome
+
+
+def _solve(key, reached):
+    """
+    Find outputs for the call with fingerprint KEY and the calls that it is solving for
+    that reproduce themselves, meaning that each is the output its own call chooses when
+    the outputs of the others are assumed. We attempt each call in turn, replacing the
+    output assumed for it by the output it chooses, until a round passes in which none
+    changes. We do this starting from each possible output of KEY, and among the solutions
+    found take the one in which KEY's output has the highest expected utility, or the
+    first found among equals. Returns the set of calls led to and the outcome for KEY, or
+    None if no solution was found.
+    """
+    reached = set(reached)
+    solutions = []
+    for start in _candidates(key):
+        _in_progress[key] = (start, start)
+        seen = set()
+        while _outer(key, reached) is None:
+            calls = _members[key] + [key]
+            state = tuple(_in_progress[n][0] for n in calls)
+            if state in seen:
+                # the outputs are going round in a cycle
+                break
+            seen.add(state)
+            changed = False
+            for n in calls:
+                attempt_reached, outcome = _attempt(n)
+                reached |= attempt_reached
+                if outcome[1] != _in_progress[n][0]:
+                    _in_progress[n] = (outcome[1], outcome[1])
+                    changed = True
+            if not changed:
+                solutions.append(outcome)
+                break
+    reached.update(_members[key])
+    return reached, max(solutions, key=lambda outcome: outcome[2], default=None)
+
+
+def _outer(key, reached):
+    """
+    The outermost call in progress, other than the call with fingerprint KEY, that solves
+    for one of the calls in REACHED, or None.
+    """
+    roots = {_root.get(n, n) for n in reached if n in _in_progress} - {key}
+    return next((n for n in _in_progress if n in roots), None)
+
+
+def _candidates(key):
+    """
+    The possible outputs of the call with fingerprint KEY, which are the possible values of
+    its first logical identity node.
+    """
+    _, world_model, _, _, _, logical_identity, *_ = _calls[key]
+    return world_model.nodes[logical_identity[0]]
+
+
+def decide_all_observations(theory, world_model, observed_nodes, utility_node, physical_identity, logical_identity,
+                            backend="enumeration", **options):
+    """
+    Use a decision theory to choose an action under every possible assignment of values to
+    OBSERVED_NODES. Returns one row per assignment, as a dict giving the observations, the
+    expected utility of each intervention value, the value chosen, and that value passed
+    through the theory's output formatter.
+
+    Rather than running inference once per assignment, we perform the theory's surgery
+    with nothing observed and compute the joint distribution of the observed nodes, the
+    intervention node and the utility node by variable elimination, just once. The
+    observed nodes then act as extra axes of the table of expected utilities. With the
+    "junction_tree" backend we instead calibrate one junction tree for that graph, and
+    query it once per assignment with the observations as evidence, which only recomputes
+    the messages from the parts of the tree that the observations are about. This relies
+    on the surgery for each assignment giving either that same graph conditioned on the
+    observations, or that same graph unchanged. A theory can declare which by having an
+    attribute surgery_given_observations of "conditioned" or "unchanged", where
+    "unchanged" means that only its output formatter depends on the observations. For
+    other theories we check which for each assignment, factor by factor (see
+    _same_graph). Assignments that fail the check, and every assignment for theories that
+    need observations to do their surgery (see ObservationRequired), are decided one at
+    a time by decide() using BACKEND instead. Assignments that have zero probability are
+    left out.
+    """
+    assignments = [dict(zip(observed_nodes, values))
+                   for values in itertools.product(*(world_model.nodes[n] for n in observed_nodes))]
+    try:
+        with profiling.phase("surgery"):
+            unobserved_model, intervention_node, _ = theory(world_model, {}, utility_node, physical_identity,
+                                                            logical_identity)
+    except ObservationRequired:
+        unobserved_model = None
+    declared = getattr(theory, "surgery_given_observations", None)
+
+    tree = None
+    if unobserved_model is not None and backend == "junction_tree":
+        with profiling.phase("inference"):
+            tree = inference.calibrated_tree(unobserved_model, [intervention_node, utility_node])
+    elif unobserved_model is not None:
+        with profiling.phase("inference"):
+            joint = unobserved_model.marginal(list(observed_nodes) + [intervention_node, utility_node])
+        utilities = np.array(unobserved_model.nodes[utility_node], dtype=float)
+        weighted, total = joint @ utilities, joint.sum(axis=-1)
+
+    rows = []
+    for observations, codes in zip(assignments, itertools.product(*(range(len(world_model.nodes[n]))
+                                                                      for n in observed_nodes))):
+        expected_utilities = None
+        if unobserved_model is not None:
+            with profiling.phase("surgery"):
+                modified_model, node, output_formatter = theory(world_model, observations, utility_node,
+                                                                physical_identity, logical_identity)
+            # whether the surgery left the graph unchanged or conditioned it on the observations
+            matches = None
+            if node == intervention_node and declared is not None:
+                matches = declared
+            elif node == intervention_node and _same_graph(modified_model, unobserved_model):
+                matches = "unchanged"
+            elif node == intervention_node and _same_graph(modified_model,
+                                                           conditionalize(unobserved_model, **observations)):
+                matches = "conditioned"
+            if matches is not None and tree is not None:
+                with profiling.phase("inference"):
+                    joint = tree.query([intervention_node, utility_node],
+                                       evidence=observations if matches == "conditioned" else None)
+                expected_utilities = inference.expectations_from_joint(unobserved_model, intervention_node,
+                                                                       utility_node, joint)
+            elif matches == "unchanged":
+                # the surgery ignores the observations
+                expected_utilities = inference.expectations_from_sums(
+                    unobserved_model, intervention_node, weighted.sum(axis=tuple(range(len(codes)))),
+                    total.sum(axis=tuple(range(len(codes)))))
+            elif matches == "conditioned":
+                expected_utilities = inference.expectations_from_sums(
+                    unobserved_model, intervention_node, weighted[codes], total[codes])
+        if expected_utilities is not None:
+            if not expected_utilities:
+                continue
+            output = max(expected_utilities, key=expected_utilities.get)
+            formatted_output = output_formatter(output)
+        else:
+            try:
+                output, formatted_output = decide(theory, world_model, observations, utility_node,
+                                                  physical_identity, logical_identity, backend=backend, **options)
+            except Exception as e:
+                output = formatted_output = f"error: {e}"
+        rows.append({
+            "observations": observations,
+            "expected_utilities": expected_utilities,
+            "output": output,
+            "formatted_output": formatted_output,
+        })
+    return rows
+
+
+def _same_graph(model, reference):
+    """
+    Check whether MODEL has the same nodes with the same possible values as REFERENCE, and
+    whether each of its factors is either the same factor as the one in the same place in
+    REFERENCE or a factor over the same nodes with the same fingerprint. Like comparing the
+    fingerprints of the graphs, this shows that they define the same distribution, but
+    only the factors that are not shared are tabulated, and only if their scopes agree.
+    """
+    if list(model.nodes.items()) != list(reference.nodes.items()) or len(model.factors) != len(reference.factors):
+        return False
+    return all(factor is other or (factor.consequence == other.consequence and factor.causes == other.causes
+                                   and factor.fingerprint(model.nodes) == other.fingerprint(reference.nodes))
+               for factor, other in zip(model.factors, reference.factors))
+
+
+def fingerprint(theory, world_model, observations, utility_node, physical_identity, logical_identity,
+                backend, options):
+    """
+    Compute a digest that identifies a call to decide() by the structure of its arguments:
+    which theory is used, the possible values and tabulated factors of the world model, and
+    everything else that can affect the result. The theory is identified by the object
+    itself rather than by its name, since two theories made by the same function, such as
+    two closures or two partials, can have the same name and behave differently.
+    """
+    _theories.setdefault(id(theory), theory)
+    digest = hashlib.sha256(world_model.fingerprint().encode())
+    digest.update(repr((
+        id(theory),
+        sorted(observations.items(), key=lambda item: item[0]),
+        utility_node,
+        physical_identity,
+        list(logical_identity),
+        backend,
+        sorted(options.items()),
+    )).encode())
+    return digest.hexdigest()
+
+
+def _decide(theory, world_model, observations, utility_node, physical_identity, logical_identity, args,
+            backend, prune, **options):
     if args and args.initial_verbose:
         world_model.view(filename="Initial")
     if args and args.verbose:
@@ -10,13 +388,14 @@ def decide(theory, world_model, observations, utility_node, physical_identity, l
             print(f"  {node:20s} ∊ {values}")
         print(f"INITIAL FACTORS:")
         for factor in world_model.factors:
-            print(f"  {factor.consequence:20s} <= {factor.causes}")
+            print(f"  {factor.consequence or '(observation)':20s} <= {factor.causes}")
     
     # use the decision theory to perform surgery to get a factor graph where our
     # decision can be taken by maximizing expected utility coniditioned on a single
     # "intervention" node. In the below, this intervention node is the name of a node
     # in modified_model
-    modified_model, intervention_node, output_formatter = theory(world_model, observations, utility_node, physical_identity, logical_identity)
+    with profiling.phase("surgery"):
+        modified_model, intervention_node, output_formatter = theory(world_model, observations, utility_node, physical_identity, logical_identity)
 
     if args and args.modified_verbose:
         modified_model.view(filename="Modified")
@@ -26,20 +405,25 @@ def decide(theory, world_model, observations, utility_node, physical_identity, l
             print(f"  {node:20s} ∊ {values}")
         print(f"MODIFIED FACTORS:")
         for factor in modified_model.factors:
-            print(f"  {factor.consequence:20s} <= {factor.causes}")
+            print(f"  {factor.consequence or '(observation)':20s} <= {factor.causes}")
 
-    worlds = pd.DataFrame(itertools.product(*modified_model.nodes.values()), columns=modified_model.nodes)
-    worlds['prob'] = worlds.apply(modified_model.evaluate, axis=1)
-    worlds = worlds[worlds['prob'] != 0]
-    if args and args.verbose:
-        print(worlds.sort_values(intervention_node))
-    expected_utilities = worlds.groupby(intervention_node).apply(
-        lambda group: (group[utility_node] * group.prob).sum() / group.prob.sum(),
-        include_groups=False)
+    # remove the nodes that cannot affect the joint distribution of the intervention node
+    # and the utility node
+    if prune:
+        with profiling.phase("pruning"):
+            modified_model, removed = relevant_subgraph(modified_model, [utility_node, intervention_node])
+        if args and args.verbose:
+            print(f"PRUNED NODES: {removed}")
+
+    # compute the expected utility for each possible value of the intervention node using
+    # whichever inference backend was requested
+    with profiling.phase("inference"):
+        expected_utilities = inference.BACKENDS[backend](modified_model, intervention_node, utility_node,
+                                                         verbose=bool(args and args.verbose), **options)
     if args and args.verbose:
         for intervention, expectation in expected_utilities.items():
             print(f"expected utility of {intervention} = {expectation}")
     
     # pick the intervention with highest expected utility
-    output = expected_utilities.idxmax()
-    return output, output_formatter(output)
+    output = max(expected_utilities, key=expected_utilities.get)
+    return output, output_formatter(output), expected_utilities[output]
@@ -1,5 +1,15 @@
+import collections
+import collections.abc
+import hashlib
+import itertools
+import os
+import time
 from typing import Callable, Any
 
+import numpy as np
+
+import profiling
+
 class Factor(object):
     """
     A factor is a conditional probability that may appear in a factor graph. It has
@@ -19,8 +29,32 @@ class Factor(object):
 
     It is assumed that the conditional probability produces outputs between 0 and 1, and
     that those outputs sum to 1 over the possible values of the consequence node.
+
+    A deterministic factor additionally has a function that computes the value of the
+    consequence from the values of the causes. Inference engines can use this to assign the
+    consequence directly instead of trying every possible value. For other factors the
+    function is None.
+
+    A factor may also have no consequence at all, in which case its consequence is None and
+    it weighs the values of its causes rather than giving a probability to a node of its
+    own. When a factor graph is conditioned on an observation of a node, the factor that
+    had the observed node as its consequence is left like this, and weighs the values of
+    its causes by how likely they were to produce the observation. A problem can also use
+    such a factor to constrain which combinations of values its causes can take together,
+    as problems.build_many_rooms does.
+
+    A symmetric factor has causes that all share the same possible values, and depends on
+    them only through how many causes take each value, so that permuting the causes makes
+    no difference. Such a factor additionally has a conditional of counts, which takes the
+    value of the consequence and a Counter from values of the causes to the number of
+    causes taking that value. Inference engines can use this to reason about counts
+    instead of individual assignments. For other factors it is None.
     """
-    def __init__(self, consequence: str, causes: list[str], conditional: Callable[..., float]):
+    __slots__ = ("consequence", "causes", "conditional", "function", "conditional_of_counts",
+                 "_table", "_table_domains", "_fingerprint", "_fingerprint_domains")
+
+    def __init__(self, consequence: str, causes: list[str], conditional: Callable[..., float],
+                 function: Callable[..., Any] = None, conditional_of_counts: Callable[..., float] = None):
         if not isinstance(causes, list):
             raise Exception(f"Factor constructed with causes={causes}, expected list of strings")
         if not all(isinstance(cause, str) for cause in causes):
@@ -28,10 +62,121 @@ class Factor(object):
         self.consequence = consequence
         self.causes = causes
         self.conditional = conditional
+        self.function = function
+        self.conditional_of_counts = conditional_of_counts
+        self._table = None
+        self._table_domains = None
+        self._fingerprint = None
+        self._fingerprint_domains = None
 
     def __call__(self, *values):
         return self.conditional(*values)
 
+    @property
+    def scope(self):
+        """
+        The names of all the nodes this factor touches: the consequence followed by the causes.
+        """
+        if self.consequence is None:
+            return list(self.causes)
+        return [self.consequence] + self.causes
+
+    def to_table(self, nodes):
+        """
+        Evaluate the conditional probability once for every combination of values of the
+        nodes in this factor's scope, and return the result as an array with one axis for the
+        consequence followed by one axis per cause. Each axis is indexed by position within
+        that node's list of possible values in NODES. The table is cached, so calling this
+        again with the same possible values does not re-evaluate the conditional.
+
+        For a deterministic factor we instead evaluate the function once for every
+        combination of values of the causes, and return a DeterministicTable, which can be
+        indexed in the same way as the array but does not store a column for every value of
+        the consequence.
+        """
+        domains = [nodes[n] for n in self.scope]
+        if self._table is None or self._table_domains != domains:
+            with profiling.phase("evaluation"):
+                start = time.perf_counter()
+                if self.function is not None and self.consequence is not None:
+                    positions = {value: code for code, value in enumerate(domains[0])}
+                    codes = np.array([positions.get(self.function(*values), -1)
+                                      for values in itertools.product(*domains[1:])], dtype=int)
+                    table = DeterministicTable(codes.reshape([len(d) for d in domains[1:]]), len(domains[0]))
+                    size = codes.size
+                else:
+                    table = np.array([self.conditional(*values) for values in itertools.product(*domains)], dtype=float)
+                    table = table.reshape([len(d) for d in domains])
+                    size = table.size
+                if profiling.current is not None:
+                    profiling.current.add_factor_calls(self, size, time.perf_counter() - start)
+                    profiling.current.add_state_space(size)
+            self._table = table
+            self._table_domains = domains
+        return self._table
+
+    def lookup(self, nodes):
+        """
+        Return a function that takes a tuple of codes for the nodes in this factor's scope,
+        indexed as for to_table(), and gives the conditional probability. If the factor has
+        already been tabulated over the possible values in NODES, the function looks it up
+        in the table. Otherwise the conditional probability is evaluated the first time each
+        combination of codes is asked for and then remembered, so that a search that only
+        reaches a few combinations never tabulates the rest.
+        """
+        domains = [nodes[n] for n in self.scope]
+        if self._table is not None and self._table_domains == domains:
+            table = self._table
+            return lambda codes: table[codes]
+
+        evaluated = {}
+
+        def probability(codes):
+            if codes not in evaluated:
+                start = time.perf_counter()
+                evaluated[codes] = float(self.conditional(*(d[c] for d, c in zip(domains, codes))))
+                if profiling.current is not None:
+                    profiling.current.add_factor_calls(self, 1, time.perf_counter() - start)
+            return evaluated[codes]
+
+        return probability
+
+    def fingerprint(self, nodes):
+        """
+        Compute a digest that identifies this factor by the nodes it touches, their possible
+        values in NODES, and its tabulated conditional probability. Like the table, the
+        digest is cached, so calling this again with the same possible values does not hash
+        the table again.
+        """
+        domains = [nodes[n] for n in self.scope]
+        if self._fingerprint is None or self._fingerprint_domains != domains:
+            digest = hashlib.sha256(repr((self.consequence, self.causes, domains)).encode())
+            if self.conditional_of_counts is not None:
+                # the full table of a symmetric factor can be far too large to build
+                digest.update(b"counts")
+                digest.update(self.to_count_table(nodes).tobytes())
+            else:
+                digest.update(self.to_table(nodes).tobytes())
+            self._fingerprint = digest.hexdigest()
+            self._fingerprint_domains = domains
+        return self._fingerprint
+
+    def to_count_table(self, nodes):
+        """
+        Evaluate the conditional of counts of a symmetric factor once for every value of the
+        consequence and every way of dividing the causes among their possible values, and
+        return the result as an array with one axis for the consequence and one axis for the
+        counts, in the order generated by count_vectors(). A factor with no consequence has a
+        single row, for which the conditional of counts is called with None.
+        """
+        values = nodes[self.causes[0]] if self.causes else []
+        table = [
+            [self.conditional_of_counts(consequence, collections.Counter(dict(zip(values, counts))))
+             for counts in count_vectors(len(self.causes), len(values))]
+            for consequence in (nodes[self.consequence] if self.consequence is not None else [None])
+        ]
+        return np.array(table, dtype=float)
+
     @classmethod
     def uniform(cls, node_name, probability):
         """
@@ -63,7 +208,8 @@ class Factor(object):
         return Factor(
             consequence,
             [cause],
-            lambda consequence, cause: float(consequence == cause))
+            lambda consequence, cause: float(consequence == cause),
+            function=lambda cause: cause)
 
     @classmethod
     def deterministic(cls, consequence, causes, f):
@@ -74,7 +220,31 @@ class Factor(object):
         return Factor(
             consequence,
             causes,
-            lambda consequence, *causes: float(consequence == f(*causes))
+            lambda consequence, *causes: float(consequence == f(*causes)),
+            function=f,
+        )
+
+    @classmethod
+    def symmetric(cls, consequence, causes, conditional_of_counts):
+        """
+        Create a factor whose conditional probability depends on the causes only through how
+        many of them take each value. CONDITIONAL_OF_COUNTS is called with the value of the
+        consequence and a Counter from values of the causes to the number of causes taking
+        that value. With no consequence, the factor weighs the values of the causes by how
+        many take each value, and CONDITIONAL_OF_COUNTS is called with None instead.
+        """
+        if consequence is None:
+            return Factor(
+                None,
+                causes,
+                lambda *causes: conditional_of_counts(None, collections.Counter(causes)),
+                conditional_of_counts=conditional_of_counts,
+            )
+        return Factor(
+            consequence,
+            causes,
+            lambda consequence, *causes: conditional_of_counts(consequence, collections.Counter(causes)),
+            conditional_of_counts=conditional_of_counts,
         )
 
     @classmethod
@@ -83,7 +253,171 @@ class Factor(object):
         Create a factor that wraps another factor and always sets the nodes named in the
         keys of VALUES to their repsective values.
         """
-        raise Exception("TODO")
+        values = {node: value for node, value in values.items() if node in factor.scope}
+        if not values:
+            return factor
+
+        consequence = None if factor.consequence in values else factor.consequence
+        causes = [cause for cause in factor.causes if cause not in values]
+        remaining = ([] if consequence is None else [consequence]) + causes
+
+        def conditional(*remaining_values):
+            given = dict(zip(remaining, remaining_values), **values)
+            return factor.conditional(*(given[n] for n in factor.scope))
+
+        function = None
+        if factor.function is not None and consequence is not None:
+            def function(*cause_values):
+                given = dict(zip(causes, cause_values), **values)
+                return factor.function(*(given[n] for n in factor.causes))
+
+        # the causes that remain are still interchangeable, and the fixed causes simply
+        # add to the counts
+        conditional_of_counts = None
+        if factor.conditional_of_counts is not None:
+            fixed_counts = collections.Counter(values[n] for n in factor.causes if n in values)
+
+            def conditional_of_counts(consequence_value, counts):
+                if factor.consequence in values:
+                    consequence_value = values[factor.consequence]
+                return factor.conditional_of_counts(consequence_value, counts + fixed_counts)
+
+        return Factor(consequence, causes, conditional, function=function,
+                      conditional_of_counts=conditional_of_counts)
+
+
+class DeterministicTable(object):
+    """
+    The tabulated conditional probability of a deterministic factor, stored as the code of
+    the consequence for each combination of codes of the causes, rather than as a
+    probability for each combination of codes of the consequence and the causes. CODES is
+    an integer array with one axis per cause, holding -1 wherever the function gives a
+    value that is not a possible value of the consequence, and NUM_VALUES is the number of
+    possible values of the consequence.
+
+    Indexing it with codes for the consequence followed by codes for each cause gives the
+    same probabilities as indexing the full table would, by looking up the consequence
+    code for the causes and comparing. Converting it to a NumPy array gives the full
+    table, which contract() avoids doing wherever it can.
+    """
+    __slots__ = ("codes", "num_values")
+
+    def __init__(self, codes, num_values):
+        self.codes = codes
+        self.num_values = num_values
+
+    @property
+    def shape(self):
+        return (self.num_values,) + self.codes.shape
+
+    def __getitem__(self, index):
+        consequence, causes = index[0], tuple(index[1:])
+        looked_up = self.codes[causes]
+        if isinstance(consequence, slice):
+            return np.equal.outer(np.arange(self.num_values)[consequence], looked_up).astype(float)
+        return (looked_up == consequence).astype(float)
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.arange(self.num_values).reshape((-1,) + (1,) * self.codes.ndim)
+        return (values == self.codes).astype(dtype or float)
+
+    def valid(self):
+        """
+        For each combination of codes of the causes, 1 if the function gives a possible value
+        of the consequence and 0 otherwise.
+        """
+        return (self.codes >= 0).astype(float)
+
+    def tobytes(self):
+        return repr(self.shape).encode() + self.codes.tobytes()
+
+
+class PolicySpace(collections.abc.Sequence):
+    """
+    The possible values of a node that represents a policy, which is a function from a
+    list of possible inputs to a list of possible outputs. Each policy is a tuple giving the
+    output for each input in turn, and policies are listed in the same order as
+    itertools.product(outputs, repeat=len(inputs)) would list them.
+
+    There are len(outputs) ** len(inputs) policies, so rather than storing them we generate
+    each one on demand from its position in the list.
+    """
+    __slots__ = ("input_space", "output_space", "input_index", "_output_index")
+
+    def __init__(self, input_space, output_space):
+        self.input_space = list(input_space)
+        self.output_space = list(output_space)
+        self.input_index = {inputs: i for i, inputs in enumerate(self.input_space)}
+        self._output_index = {output: i for i, output in enumerate(self.output_space)}
+
+    def __len__(self):
+        return len(self.output_space) ** len(self.input_space)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"policy index {index} out of range")
+        outputs = []
+        for _ in self.input_space:
+            index, output = divmod(index, len(self.output_space))
+            outputs.append(self.output_space[output])
+        return tuple(reversed(outputs))
+
+    def __iter__(self):
+        return itertools.product(self.output_space, repeat=len(self.input_space))
+
+    def __contains__(self, policy):
+        return (isinstance(policy, tuple) and len(policy) == len(self.input_space)
+                and all(output in self._output_index for output in policy))
+
+    def index(self, policy):
+        if policy not in self:
+            raise ValueError(f"{policy!r} is not a policy in {self!r}")
+        index = 0
+        for output in policy:
+            index = index * len(self.output_space) + self._output_index[output]
+        return index
+
+    def __eq__(self, other):
+        return (isinstance(other, PolicySpace) and self.input_space == other.input_space
+                and self.output_space == other.output_space)
+
+    def __hash__(self):
+        return hash((tuple(self.input_space), tuple(self.output_space)))
+
+    def __repr__(self):
+        return f"PolicySpace({self.input_space!r}, {self.output_space!r})"
+
+
+class FactorOverlay(collections.abc.Sequence):
+    """
+    The factors of a factor graph that was derived from another factor graph by removing
+    the factors for some consequences and adding some new factors. Only the changes are
+    stored, and the list of factors is put together the first time it is needed, so that
+    creating the overlay costs time proportional to the size of the change.
+    """
+    __slots__ = ("base", "removed", "added", "_factors")
+
+    def __init__(self, base, removed, added):
+        self.base = base
+        self.removed = removed
+        self.added = added
+        self._factors = None
+
+    def _materialize(self):
+        if self._factors is None:
+            self._factors = [f for f in self.base if f.consequence not in self.removed] + self.added
+        return self._factors
+
+    def __len__(self):
+        return len(self._materialize())
+
+    def __getitem__(self, index):
+        return self._materialize()[index]
+
+    def __iter__(self):
+        return iter(self._materialize())
 
 
 class FactorGraph(object):
@@ -92,48 +426,223 @@ class FactorGraph(object):
     of those nodes, and a list of factors defined over those nodes.
 
     It is assumed that every node appears as a consequence in exactly one factor, so
-    the number of factors will always equal the number of nodes.
+    the number of factors will always equal the number of nodes, except that a graph may
+    also contain factors with no consequence. These are left behind by conditioning on
+    observations, and can also constrain the values of their causes (see Factor).
+
+    Internally, the value of each node in a possible world is represented by its position
+    within that node's list of possible values, which we call its code. A possible world is
+    then a row of small unsigned integers, one per node, in the order the nodes are listed.
     """
+    __slots__ = ("nodes", "factors", "_factor_axes")
+
     def __init__(self, nodes: dict[str, list[str]], factors: list[Factor]):
         self.nodes = nodes
         self.factors = factors
+        self._factor_axes = None
 
     def evaluate(self, world: dict[str, Any]):
         """
         Evaluate the probability of a possible world. A posssible world is a map from
         node names to the value of that node in this world. We evaluate each factor and
         multiply the results together to get a probability.
+
+        This is for looking at a single world by hand. The inference backends never look up
+        worlds by node name, and instead work with rows of codes, which they score in bulk
+        by looking up tabulated factors (see inference.world_chunks).
         """
+        values = [world[n] for n in self.nodes]
         probability = 1.
-        for factor in self.factors:
-            node_names = [factor.consequence] + factor.causes
-            node_values = [world[n] for n in node_names]
-            probability *= factor(*node_values)
+        profile = profiling.current
+        for factor, axes in zip(self.factors, self.factor_axes()):
+            if profile is None:
+                probability *= factor(*(values[a] for a in axes))
+            else:
+                start = time.perf_counter()
+                probability *= factor(*(values[a] for a in axes))
+                profile.add_factor_calls(factor, 1, time.perf_counter() - start)
         return probability
-    
+
+    def with_changes(self, add_nodes=None, remove_factors=(), add_factors=()):
+        """
+        Create a factor graph that differs from this one by adding the nodes in ADD_NODES (a
+        map from node names to possible values), removing the factors whose consequences are
+        named in REMOVE_FACTORS, and adding the factors in ADD_FACTORS. The new graph shares
+        this graph's nodes and factors rather than copying them, so any factor that is kept
+        also keeps its tabulated conditional probability.
+        """
+        nodes = self.nodes
+        if add_nodes:
+            nodes = collections.ChainMap(dict(add_nodes), self.nodes)
+        factors = self.factors
+        if remove_factors or add_factors:
+            factors = FactorOverlay(self.factors, set(remove_factors), list(add_factors))
+        return FactorGraph(nodes, factors)
+
+    def factor_axes(self):
+        """
+        For each factor, the positions among this graph's nodes of the nodes in its scope.
+        """
+        if self._factor_axes is None:
+            axes = {node: axis for axis, node in enumerate(self.nodes)}
+            self._factor_axes = [np.array([axes[n] for n in factor.scope], dtype=int) for factor in self.factors]
+        return self._factor_axes
+
+    def code_dtype(self):
+        """
+        The smallest unsigned integer type that can hold the code of any node's value.
+        """
+        largest = max((len(values) for values in self.nodes.values()), default=1)
+        return np.min_scalar_type(max(largest - 1, 0))
+
+    def fingerprint(self):
+        """
+        Compute a digest that identifies this factor graph by its nodes, their possible values,
+        and the tabulated conditional probabilities of its factors. Two factor graphs with the
+        same fingerprint define the same distribution over the same possible worlds.
+        """
+        digest = hashlib.sha256(repr(list(self.nodes.items())).encode())
+        for factor in self.factors:
+            digest.update(factor.fingerprint(self.nodes).encode())
+        return digest.hexdigest()
+
+    def compile(self):
+        """
+        Tabulate every factor in this graph over the possible values of the nodes it touches.
+        Returns a list of (scope, table) pairs, one per factor, in the same order as the factors.
+        """
+        return [(factor.scope, factor.to_table(self.nodes)) for factor in self.factors]
+
+    def evaluate_all(self):
+        """
+        Evaluate the probability of every possible world at once. The result is an array with
+        one axis per node, in the order the nodes are listed in this graph, where each axis is
+        indexed by position within that node's list of possible values. Flattening this array
+        gives the probabilities in the same order as itertools.product over the node values.
+        """
+        potentials = self.compile() + [([node], np.ones(len(values))) for node, values in self.nodes.items()]
+        return contract(potentials, list(self.nodes))
+
+    def topological_order(self):
+        """
+        List the nodes so that every node comes after all the causes in the factor that has it
+        as a consequence. Nodes that are not the consequence of any factor come first.
+        """
+        causes = {node: set() for node in self.nodes}
+        for factor in self.factors:
+            if factor.consequence is not None:
+                causes[factor.consequence].update(factor.causes)
+        order = []
+        placed = set()
+        while len(order) < len(self.nodes):
+            ready = [n for n in self.nodes if n not in placed and causes[n] <= placed]
+            if not ready:
+                raise Exception(f"factor graph has a cycle among {[n for n in self.nodes if n not in placed]}")
+            order.extend(ready)
+            placed.update(ready)
+        return order
+
+    def elimination_order(self, keep=(), connect=()):
+        """
+        Choose an order in which to sum out every node not in KEEP. We use the greedy
+        min-fill heuristic: at each step we eliminate the node whose elimination would add
+        the fewest new edges between its neighbours, breaking ties by fewest neighbours.
+        Each list of nodes in CONNECT is treated as if some factor touched all of them.
+        """
+        neighbours = {node: set() for node in self.nodes}
+        for scope in [factor.scope for factor in self.factors] + [list(c) for c in connect]:
+            for node in scope:
+                neighbours[node].update(n for n in scope if n != node)
+
+        def cost(node):
+            fill = sum(1 for a, b in itertools.combinations(neighbours[node], 2) if b not in neighbours[a])
+            return fill, len(neighbours[node])
+
+        remaining = [node for node in self.nodes if node not in keep]
+        order = []
+        while remaining:
+            node = min(remaining, key=cost)
+            remaining.remove(node)
+            order.append(node)
+            adjacent = neighbours.pop(node)
+            for a in adjacent:
+                neighbours[a].discard(node)
+                neighbours[a].update(adjacent - {a})
+        return order
+
+    def marginal(self, query):
+        """
+        Compute the joint probability of the nodes in QUERY by variable elimination, summing
+        out every other node one at a time rather than enumerating possible worlds. The
+        result is an array with one axis per query node, in the order given, where each axis
+        is indexed by position within that node's list of possible values.
+        """
+        potentials = self.compile()
+        with profiling.phase("elimination"):
+            for node in self.elimination_order(keep=query):
+                involved = [p for p in potentials if node in p[0]]
+                if not involved:
+                    # a node with no factors contributes a weight of 1 for each of its values
+                    involved = [([node], np.ones(len(self.nodes[node])))]
+                potentials = [p for p in potentials if node not in p[0]]
+                scope = list(dict.fromkeys(n for s, _ in involved for n in s if n != node))
+                potentials.append((scope, contract(involved, scope)))
+            potentials.extend(([node], np.ones(len(self.nodes[node]))) for node in query)
+            return contract(potentials, list(query))
+
     def view(self, *args, **kwargs):
         """
         Render and open a .pdf of self in out/ using graphviz.
+
+        The edge from the last cause of each factor is labelled with a heatmap of its
+        conditional probability, with one row per combination of values of the causes and
+        one column per value of the consequence. Heatmaps are drawn from the tabulated
+        factors and named after the factor's fingerprint, so a factor that was already
+        drawn, for example by an earlier view of the same graph before surgery, is not
+        drawn again. The others are drawn in parallel. Factors with more than
+        MAX_HEATMAP_CELLS entries in their table are left without a heatmap.
         """
+        import concurrent.futures
         import graphviz
+        directory = kwargs.setdefault("directory", "out")
+        os.makedirs(directory, exist_ok=True)
+
         dot = graphviz.Digraph()
         for node, values in self.nodes.items():
             dot.node(node,f"<<b>{node}</b><font point-size=\"10\">{''.join(f'<br/>{v}' for v in values)}</font>>")
+        to_draw = {}
         for factor in self.factors:
+            if factor.consequence is None:
+                continue
+            edgeattrs = {}
+            if factor.causes and np.prod([len(self.nodes[n]) for n in factor.scope]) <= MAX_HEATMAP_CELLS:
+                filename = f"heatmap_{factor.fingerprint(self.nodes)[:16]}.png"
+                if not os.path.exists(os.path.join(directory, filename)):
+                    to_draw[filename] = factor.to_table(self.nodes)
+                edgeattrs["label"] = f'<<TABLE border="0" cellspacing="0"><TR><TD><IMG SRC="{filename}"/></TD></TR></TABLE>>'
             for cause in factor.causes:
-                edgeattrs={}
-                if len(factor.causes) == 1:
-                    import numpy as np
-                    from PIL import Image
-                    probs = np.array([[factor.conditional(y,x) for y in self.nodes[factor.consequence]] for x in self.nodes[factor.causes[0]]])
-                    normed = (probs / probs.max() * 255).astype(np.uint8)
-                    filename=f'{kwargs.get("filename")}_{factor.consequence}_{factor.causes[0]}.png'
-                    Image.fromarray(normed).resize((40,40),resample=Image.NEAREST).save(f"out/{filename}")
-                    edgeattrs["label"] = f'<<TABLE border="0" cellspacing="0"><TR><TD><IMG SRC="{filename}"/></TD></TR></TABLE>>'
-                dot.edge(cause, factor.consequence, **edgeattrs)
-        kwargs.setdefault("directory", "out")
+                dot.edge(cause, factor.consequence, **(edgeattrs if cause == factor.causes[-1] else {}))
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            list(executor.map(_draw_heatmap, to_draw.values(),
+                              [os.path.join(directory, filename) for filename in to_draw]))
         dot.view(*args, **kwargs)
 
+# the largest table that FactorGraph.view() will draw a heatmap of
+MAX_HEATMAP_CELLS = 1 << 16
+
+
+def _draw_heatmap(table, path):
+    """
+    Save a heatmap of a tabulated factor to PATH as a PNG, with one row per combination of
+    values of the causes and one column per value of the consequence.
+    """
+    from PIL import Image
+    probs = np.asarray(table).reshape(table.shape[0], -1).T
+    normed = (probs / max(probs.max(), 1e-300) * 255).astype(np.uint8)
+    Image.fromarray(normed).resize((40, 40), resample=Image.NEAREST).save(path)
+
+
 def conditionalize(world_model, **values):
     """
     Given a factor graph, create a new factor graph representing a conditional distribution.
@@ -143,5 +652,145 @@ def conditionalize(world_model, **values):
     new factor graph, the probabilities returned are always conditioned on the respective
     values.
     """
-    # TODO: curry each factor in world_model on VALUES; remove the nodes in VALUES from the
-    # list of nodes
+    for node, value in values.items():
+        if node not in world_model.nodes:
+            raise Exception(f"cannot condition on {node}={value!r}: no such node")
+        if value not in world_model.nodes[node]:
+            raise Exception(f"cannot condition on {node}={value!r}: expected one of {world_model.nodes[node]}")
+    nodes = {node: possible_values for node, possible_values in world_model.nodes.items() if node not in values}
+    factors = [Factor.curry(factor, **values) for factor in world_model.factors]
+    return FactorGraph(nodes, factors)
+
+
+def relevant_subgraph(world_model, targets):
+    """
+    Remove every node whose value cannot affect the joint probability of the nodes in
+    TARGETS, together with the factor that has it as a consequence. Returns the smaller
+    factor graph and a list of the nodes that were removed.
+
+    We find the relevant nodes with the Bayes-ball algorithm (Shachter 1998), which passes
+    a ball around the graph starting from the targets. The ball bounces off observations
+    and passes through unobserved nodes according to the rules of d-separation. A node
+    whose factor is needed is one that the ball reaches from one of its consequences.
+    This removes nodes that are d-separated from the targets by the observations, and
+    also barren nodes, which are nodes that are neither targets nor observed and that have
+    no relevant descendants. The observations here are the factors with no consequence,
+    which remain after conditioning a graph on observed values.
+    """
+    parents = {node: [] for node in world_model.nodes}
+    children = {node: [] for node in world_model.nodes}
+    factor_for = {}
+    for i, factor in enumerate(world_model.factors):
+        # a factor with no consequence is treated as an observed node of its own
+        consequence = factor.consequence if factor.consequence is not None else ("observation", i)
+        factor_for[consequence] = factor
+        parents.setdefault(consequence, [])
+        children.setdefault(consequence, [])
+        for cause in factor.causes:
+            parents[consequence].append(cause)
+            children[cause].append(consequence)
+    observed = {node for node in parents if node not in world_model.nodes}
+
+    needed = set()
+    passed_down = set()
+    schedule = [(node, "from child") for node in targets]
+    while schedule:
+        node, direction = schedule.pop()
+        if direction == "from child" and node not in observed:
+            if node not in needed:
+                needed.add(node)
+                schedule.extend((parent, "from child") for parent in parents[node])
+            if node not in passed_down:
+                passed_down.add(node)
+                schedule.extend((child, "from parent") for child in children[node])
+        elif direction == "from parent":
+            if node in observed:
+                if node not in needed:
+                    needed.add(node)
+                    schedule.extend((parent, "from child") for parent in parents[node])
+            elif node not in passed_down:
+                passed_down.add(node)
+                schedule.extend((child, "from parent") for child in children[node])
+
+    kept = needed | set(targets)
+    nodes = {node: values for node, values in world_model.nodes.items() if node in kept}
+    factors = [factor for consequence, factor in factor_for.items() if consequence in needed]
+    removed = [node for node in world_model.nodes if node not in kept]
+    return FactorGraph(nodes, factors), removed
+
+
+def count_vectors(total, parts):
+    """
+    Generate every way of dividing TOTAL interchangeable items among PARTS bins, as tuples
+    giving the number of items in each bin.
+    """
+    if parts <= 1:
+        if parts == 1 or total == 0:
+            yield (total,) * parts
+        return
+    for first in range(total, -1, -1):
+        for rest in count_vectors(total - first, parts - 1):
+            yield (first,) + rest
+
+
+def contract(potentials, output):
+    """
+    Multiply together a list of (scope, array) potentials and sum out every node that is not
+    in OUTPUT, returning an array with one axis per node in OUTPUT.
+
+    The array of a potential may also be a DeterministicTable. When its consequence is
+    summed out, we never build its full table. Instead, every other potential that uses
+    the consequence looks up the consequence's code from the codes of the causes, and a
+    potential over the causes zeroes out any combination whose value is not possible.
+    """
+    potentials = list(potentials)
+    while True:
+        found = next((i for i, (scope, table) in enumerate(potentials)
+                      if isinstance(table, DeterministicTable) and scope[0] not in output), None)
+        if found is None:
+            break
+        scope, deterministic = potentials.pop(found)
+        potentials = [_substitute(s, t, scope, deterministic) if scope[0] in s else (s, t) for s, t in potentials]
+        potentials.append((scope[1:], deterministic.valid()))
+
+    labels = {}
+    operands = []
+    for scope, table in potentials:
+        operands.extend([np.asarray(table), [labels.setdefault(n, len(labels)) for n in scope]])
+    operands.append([labels[n] for n in output])
+    result = np.einsum(*operands, optimize=True)
+    if profiling.current is not None:
+        profiling.current.add_state_space(result.size)
+    return result
+
+
+def _substitute(scope, table, deterministic_scope, deterministic):
+    """
+    Replace the consequence of a deterministic table in the potential (SCOPE, TABLE) by the
+    causes that determine it, returning the new scope and table. TABLE may itself be a
+    DeterministicTable whose causes include that consequence.
+    """
+    if isinstance(table, DeterministicTable):
+        causes, codes = _gather(scope[1:], table.codes, deterministic_scope, deterministic)
+        return [scope[0]] + causes, DeterministicTable(codes, table.num_values)
+    return _gather(scope, table, deterministic_scope, deterministic)
+
+
+def _gather(scope, array, deterministic_scope, deterministic):
+    consequence, causes = deterministic_scope[0], deterministic_scope[1:]
+    new_scope = [n for n in scope if n != consequence] + [n for n in causes if n not in scope]
+    lengths = dict(zip(causes, deterministic.codes.shape))
+    lengths.update((n, length) for n, length in zip(scope, array.shape) if n != consequence)
+
+    def along(nodes, values):
+        # arrange VALUES, which has one axis per node in NODES, so that each of its axes
+        # lines up with that node's axis in the new scope
+        order = sorted(range(len(nodes)), key=lambda k: new_scope.index(nodes[k]))
+        shape = [lengths[n] if n in nodes else 1 for n in new_scope]
+        return values.transpose(order).reshape(shape)
+
+    # codes of -1 are zeroed out by the potential that contract() adds over the causes
+    consequence_codes = along(causes, np.maximum(deterministic.codes, 0))
+    index = tuple(consequence_codes if n == consequence else along([n], np.arange(lengths[n])) for n in scope)
+    return new_scope, array[index]
+
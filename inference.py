@@ -0,0 +1,957 @@
+import collections
+import hashlib
+import itertools
+import math
+import statistics
+
+import numpy as np
+
+import profiling
+from factorgraph import DeterministicTable, FactorGraph, PolicySpace, count_vectors
+from junctiontree import JunctionTree
+
+# This file contains the inference backends that decide() can use to compute, for each
+# possible value of the intervention node, the expected value of the utility node
+# conditioned on the intervention node taking that value. Every backend returns a dict
+# from intervention value to expected utility, in the order in which the intervention
+# values are listed in the factor graph, omitting any value that has zero probability.
+#
+# Backends that consider individual possible worlds count them in the current profile, if
+# there is one (see profiling.py).
+
+
+def enumeration(model, intervention_node, utility_node, verbose=False):
+    """
+    Compute expected utilities by enumerating every possible world, evaluating the
+    probability of all of them in one vectorized pass, and then averaging the utility
+    within each group of worlds that share a value for the intervention node. This is
+    exponential in the number of nodes but is the most direct translation of the
+    definition of expected utility.
+    """
+    node_names = list(model.nodes)
+    intervention_axis = node_names.index(intervention_node)
+    utility_axis = node_names.index(utility_node)
+    with profiling.phase("evaluation"):
+        prob = model.evaluate_all()
+    if profiling.current is not None:
+        profiling.current.add_worlds(prob.size, np.count_nonzero(prob))
+        profiling.current.add_state_space(prob.size)
+    if verbose:
+        codes = np.indices(prob.shape).reshape(prob.ndim, -1).T
+        order = np.argsort(codes[:, intervention_axis], kind="stable")
+        print_worlds(model, codes[order], prob.ravel()[order])
+    with profiling.phase("aggregation"):
+        joint = prob.sum(axis=tuple(a for a in range(prob.ndim) if a not in (intervention_axis, utility_axis)))
+        if intervention_axis > utility_axis:
+            joint = joint.T
+    return expectations_from_joint(model, intervention_node, utility_node, joint)
+
+
+def variable_elimination(model, intervention_node, utility_node, verbose=False):
+    """
+    Compute expected utilities from the joint distribution of the intervention node and
+    the utility node, which we get from the factor graph by variable elimination without
+    ever enumerating possible worlds.
+    """
+    joint = model.marginal([intervention_node, utility_node])
+    if verbose:
+        print(f"JOINT OF {intervention_node} AND {utility_node}:")
+        print(joint)
+    return expectations_from_joint(model, intervention_node, utility_node, joint)
+
+
+def streaming(model, intervention_node, utility_node, verbose=False, chunk_size=65536, workers=1):
+    """
+    Compute expected utilities by walking the possible worlds in fixed-size chunks and
+    accumulating, for each intervention value, the sum of probability times utility and the
+    sum of probability. Only one chunk of worlds is held in memory at a time, so memory use
+    is bounded by the chunk size rather than by the number of possible worlds.
+
+    With more than one worker, the possible worlds are split into contiguous shards that
+    are processed in separate processes, each of which returns its partial sums. The
+    workers are sent the tabulated factors rather than the factors themselves, since the
+    conditional probability functions are usually lambdas, which cannot be sent between
+    processes. Tables that were memory-mapped from a file saved by storage.py are sent as
+    the place in the file to map them from, so the workers share their pages rather than
+    each receiving a copy.
+    """
+    node_names = list(model.nodes)
+    intervention_axis = node_names.index(intervention_node)
+    utility_axis = node_names.index(utility_node)
+    utilities = np.array(model.nodes[utility_node], dtype=float)
+    num_interventions = len(model.nodes[intervention_node])
+    profile = profiling.current
+
+    if workers > 1:
+        import concurrent.futures
+
+        import storage
+        shape, dtype, potentials = _compile_axes(model)
+        potentials = [(axes, storage.shareable(table)) for axes, table in potentials]
+        size = math.prod(shape)
+        num_shards = max(1, min(4 * workers, -(-size // chunk_size)))
+        bounds = np.linspace(0, size, num_shards + 1).astype(int)
+        weighted = np.zeros(num_interventions)
+        total = np.zeros(num_interventions)
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            shards = [executor.submit(_shard_sums, shape, dtype, potentials, intervention_axis, utility_axis,
+                                      utilities, start, stop, chunk_size)
+                      for start, stop in zip(bounds[:-1], bounds[1:])]
+            for (start, stop), shard in zip(zip(bounds[:-1], bounds[1:]), shards):
+                shard_weighted, shard_total, shard_kept = shard.result()
+                weighted += shard_weighted
+                total += shard_total
+                if profile is not None:
+                    profile.add_worlds(stop - start, shard_kept)
+                    profile.add_state_space(min(chunk_size, stop - start))
+                if verbose:
+                    print(f"worlds {start} to {stop}: probability {shard_total.sum()}")
+        return expectations_from_sums(model, intervention_node, weighted, total)
+
+    weighted = np.zeros(num_interventions)
+    total = np.zeros(num_interventions)
+    for codes, prob in world_chunks(model, chunk_size):
+        if profile is not None:
+            profile.add_worlds(len(codes), np.count_nonzero(prob))
+            profile.add_state_space(len(codes))
+        with profiling.phase("aggregation"):
+            interventions = codes[:, intervention_axis]
+            weighted += np.bincount(interventions, weights=prob * utilities[codes[:, utility_axis]],
+                                    minlength=num_interventions)
+            total += np.bincount(interventions, weights=prob, minlength=num_interventions)
+        if verbose:
+            print_worlds(model, codes, prob)
+    return expectations_from_sums(model, intervention_node, weighted, total)
+
+
+def world_chunks(model, chunk_size, start=0, stop=None):
+    """
+    Generate the possible worlds of a factor graph in chunks. Worlds are numbered in the
+    same order as itertools.product over the node values, and we generate those numbered
+    from START up to STOP. Each chunk is a pair (codes, prob) where codes is an array with
+    one row per world and one column per node, giving the position of that node's value
+    within its list of possible values, and prob gives the probability of each world.
+    """
+    shape, dtype, potentials = _compile_axes(model)
+    if stop is None:
+        stop = math.prod(shape)
+    return _chunks(shape, dtype, potentials, chunk_size, start, stop)
+
+
+def _compile_axes(model):
+    """
+    Tabulate the factors of a factor graph, identifying the nodes in each factor's scope by
+    their position in the graph rather than by name. Returns the number of possible values
+    of each node, the integer type used for codes, and a list of (axes, table) pairs.
+    """
+    shape = [len(values) for values in model.nodes.values()]
+    tables = [table for _, table in model.compile()]
+    return shape, model.code_dtype(), list(zip(model.factor_axes(), tables))
+
+
+def _chunks(shape, dtype, potentials, chunk_size, start, stop):
+    for chunk_start in range(start, stop, chunk_size):
+        with profiling.phase("enumeration"):
+            indices = np.arange(chunk_start, min(chunk_start + chunk_size, stop))
+            codes = np.empty((len(indices), len(shape)), dtype=dtype)
+            for axis in reversed(range(len(shape))):
+                indices, codes[:, axis] = np.divmod(indices, shape[axis])
+        with profiling.phase("evaluation"):
+            prob = np.ones(len(codes))
+            for axes, table in potentials:
+                prob *= table[tuple(codes[:, axis] for axis in axes)]
+        yield codes, prob
+
+
+def _shard_sums(shape, dtype, potentials, intervention_axis, utility_axis, utilities, start, stop, chunk_size):
+    """
+    Compute, for the possible worlds numbered from START up to STOP, the per-intervention
+    sums of probability times utility and of probability, together with the number of
+    those worlds that have nonzero probability. This runs in a worker process, and maps
+    any tables that were sent as places in a saved file (see storage.shareable).
+    """
+    import storage
+    potentials = [(axes, storage.opened(table)) for axes, table in potentials]
+    num_interventions = shape[intervention_axis]
+    weighted = np.zeros(num_interventions)
+    total = np.zeros(num_interventions)
+    kept = 0
+    for codes, prob in _chunks(shape, dtype, potentials, chunk_size, start, stop):
+        interventions = codes[:, intervention_axis]
+        weighted += np.bincount(interventions, weights=prob * utilities[codes[:, utility_axis]],
+                                minlength=num_interventions)
+        total += np.bincount(interventions, weights=prob, minlength=num_interventions)
+        kept += np.count_nonzero(prob)
+    return weighted, total, kept
+
+
+def search(model, intervention_node, utility_node, verbose=False):
+    """
+    Compute expected utilities by depth-first search over the possible worlds that have
+    nonzero probability. Nodes are assigned in causal order, deterministic factors assign
+    their consequence directly, and a branch is abandoned as soon as its probability
+    reaches zero. The cost therefore grows with the number of possible worlds rather than
+    with the size of the cartesian product of all node values.
+    """
+    node_names = list(model.nodes)
+    intervention_axis = node_names.index(intervention_node)
+    utility_axis = node_names.index(utility_node)
+    utilities = np.array(model.nodes[utility_node], dtype=float)
+
+    weighted = np.zeros(len(model.nodes[intervention_node]))
+    total = np.zeros(len(model.nodes[intervention_node]))
+    found = []
+    for codes, prob in possible_worlds(model):
+        weighted[codes[intervention_axis]] += prob * utilities[codes[utility_axis]]
+        total[codes[intervention_axis]] += prob
+        if verbose:
+            found.append((codes, prob))
+    if found:
+        codes, prob = zip(*found)
+        print_worlds(model, np.array(codes), np.array(prob))
+    return expectations_from_sums(model, intervention_node, weighted, total)
+
+
+def possible_worlds(model, fixed=None):
+    """
+    Generate the possible worlds of a factor graph that have nonzero probability, without
+    visiting any of the others. Each world is a pair (codes, prob) where codes is a tuple
+    giving, for each node, the position of its value within its list of possible values.
+    FIXED optionally maps node names to values, in which case only the worlds where those
+    nodes take those values are generated.
+    """
+    for codes, prob, _ in _possible_worlds(model, fixed):
+        yield codes, prob
+
+
+def _possible_worlds(model, fixed=None, likely_first=False):
+    """
+    Generate the same worlds as possible_worlds(), each as a triple (codes, prob, unvisited)
+    where UNVISITED bounds from above the total probability of the worlds that are still to
+    come. With LIKELY_FIRST, the values of each node are tried from most to least probable,
+    so that most of the probability tends to be visited early.
+
+    A partial world is extended by assigning the nodes in causal order, and each factor is
+    checked once its consequence is assigned (see _search_steps). As long as the
+    probabilities that a factor gives to the values of its consequence add up to at most
+    one, which holds for any conditional probability, the worlds that extend a partial
+    world can have at most its probability in total, times the number of values of the
+    later nodes that have no factor. The bound is this total over every partial world that
+    is waiting to be extended.
+    """
+    axes, domains, positions, order, deterministic, checks = _search_steps(model, model.topological_order())
+    step_of_axis = {axis: step for step, axis in enumerate(order)}
+
+    # nodes with a fixed value have only one candidate
+    restricted = [None] * len(order)
+    for node, value in (fixed or {}).items():
+        restricted[step_of_axis[axes[node]]] = positions[axes[node]][value]
+
+    # the number of ways to extend a partial world from each step on, counting only the
+    # nodes that no factor gives a probability to
+    constrained = {factor.consequence for factor in model.factors}
+    slack = [1.] * (len(order) + 1)
+    for step in reversed(range(len(order))):
+        free = order[step] not in {axes[n] for n in constrained if n is not None} and restricted[step] is None
+        slack[step] = slack[step + 1] * (len(domains[order[step]]) if free else 1)
+
+    codes = [None] * len(domains)
+    profile = profiling.current
+    unvisited = slack[0]
+
+    def extend(step, prob):
+        nonlocal unvisited
+        if step == len(order):
+            if profile is not None:
+                profile.add_worlds(1, 1)
+            unvisited -= prob
+            yield tuple(codes), prob, max(unvisited, 0.)
+            return
+        axis = order[step]
+        if deterministic[step] is not None:
+            function, cause_axes = deterministic[step]
+            value = function(*(domains[a][codes[a]] for a in cause_axes))
+            candidates = [positions[axis][value]] if value in positions[axis] else []
+        else:
+            candidates = range(len(domains[axis]))
+        if restricted[step] is not None:
+            candidates = [code for code in candidates if code == restricted[step]]
+        extensions = []
+        for code in candidates:
+            codes[axis] = code
+            p = prob
+            for scope_axes, probability in checks[step]:
+                p *= probability(tuple(codes[a] for a in scope_axes))
+                if p == 0:
+                    break
+            if p != 0:
+                extensions.append((code, p))
+            elif profile is not None:
+                profile.add_worlds(1, 0)
+        if likely_first:
+            extensions.sort(key=lambda extension: -extension[1])
+
+        # the bound for this partial world is replaced by the bounds for its extensions
+        unvisited += sum(p for _, p in extensions) * slack[step + 1] - prob * slack[step]
+        for code, p in extensions:
+            codes[axis] = code
+            yield from extend(step + 1, p)
+
+    yield from extend(0, 1.)
+
+
+def _search_steps(model, order):
+    """
+    Prepare to search the possible worlds of MODEL by assigning its nodes one at a time in
+    ORDER, which lists the nodes so that each comes after the causes in its factor. This is
+    shared by _possible_worlds() and policy_search(). Returns the position of each node
+    among MODEL's nodes, which we call its axis, the possible values of the node on each
+    axis, a map from each of those values to its code, the axes in the order they are
+    assigned, and two lists with an entry for each step of that order.
+
+    The first list gives the deterministic factor for the node assigned at each step, as
+    a pair of its function and the axes of its causes, or None. Deterministic factors hold
+    by construction, since the search assigns their consequence, so they are never
+    tabulated or checked. The second list gives the other factors to check at each step,
+    which is the step where the last node in their scope gets assigned, as pairs of the
+    axes of their scope and a function from the codes on those axes to the conditional
+    probability (see Factor.lookup). These only evaluate the combinations of values that
+    the search reaches, so the cost grows with the number of possible worlds even when
+    some factor has a very large table.
+    """
+    axes = {node: axis for axis, node in enumerate(model.nodes)}
+    domains = list(model.nodes.values())
+    positions = [{value: code for code, value in enumerate(values)} for values in domains]
+    order = [axes[node] for node in order]
+    step_of_axis = {axis: step for step, axis in enumerate(order)}
+
+    deterministic = [None] * len(order)
+    checks = [[] for _ in order]
+    for factor in model.factors:
+        if factor.function is not None and factor.consequence is not None:
+            deterministic[step_of_axis[axes[factor.consequence]]] = (factor.function, [axes[n] for n in factor.causes])
+        else:
+            scope_axes = [axes[n] for n in factor.scope]
+            checks[max((step_of_axis[a] for a in scope_axes), default=0)].append((scope_axes,
+                                                                                 factor.lookup(model.nodes)))
+    return axes, domains, positions, order, deterministic, checks
+
+
+def anytime(model, intervention_node, utility_node, verbose=False, batch_size=64):
+    """
+    Find the intervention value with the highest expected utility without necessarily
+    visiting every possible world, by branch and bound over intervention values.
+
+    For each intervention value we visit its possible worlds a batch at a time, most
+    probable values first, taking turns between intervention values. We keep the
+    probability and the probability-weighted utility of the worlds visited so far, together
+    with a bound on the probability of the worlds not visited yet (see _possible_worlds).
+    Those worlds must lead to a utility between the smallest and largest possible values of
+    the utility node, which bounds the expected utility from above and below. An
+    intervention value is dropped as soon as its upper bound is clearly below the lower
+    bound of another, and we stop once a single value remains or every world has been
+    visited. Values whose worlds all have zero probability are dropped too.
+
+    The result contains only the intervention values that were never dropped, and their
+    expected utilities are exact only if all of their worlds were visited; otherwise they
+    are the midpoint of the bounds. Values that are within rounding error of the best are
+    reported as equal to it, so that among equally good values the first listed is chosen,
+    as with the other backends.
+    """
+    node_names = list(model.nodes)
+    utility_axis = node_names.index(utility_node)
+    utilities = np.array(model.nodes[utility_node], dtype=float)
+    lowest, highest = utilities.min(), utilities.max()
+    # expected utilities closer together than this are considered equal
+    tolerance = 1e-9 * max(abs(lowest), abs(highest), 1.)
+
+    remaining = {
+        intervention: _possible_worlds(model, fixed={intervention_node: intervention}, likely_first=True)
+        for intervention in model.nodes[intervention_node]
+    }
+    visited = {intervention: 0. for intervention in remaining}
+    weighted = {intervention: 0. for intervention in remaining}
+    lower = {intervention: lowest for intervention in remaining}
+    upper = {intervention: highest for intervention in remaining}
+    finished = set()
+
+    rounds = 0
+    while len(remaining) > 1 and not finished.issuperset(remaining):
+        rounds += 1
+        for intervention, worlds in remaining.items():
+            if intervention in finished:
+                continue
+            count = 0
+            unvisited = None
+            for codes, prob, unvisited in itertools.islice(worlds, batch_size):
+                visited[intervention] += prob
+                weighted[intervention] += prob * utilities[codes[utility_axis]]
+                count += 1
+            if count < batch_size:
+                # every world has been visited, so the expectation is exact
+                finished.add(intervention)
+                unvisited = 0.
+            elif unvisited is None:
+                unvisited = 0.
+            mass = visited[intervention] + unvisited
+            if mass != 0:
+                lower[intervention] = (weighted[intervention] + unvisited * lowest) / mass
+                upper[intervention] = (weighted[intervention] + unvisited * highest) / mass
+
+        # an intervention value with no possible worlds at all has no expected utility
+        remaining = {i: worlds for i, worlds in remaining.items() if i not in finished or visited[i] != 0}
+        best_lower = max((lower[intervention] for intervention in remaining), default=lowest)
+        remaining = {i: worlds for i, worlds in remaining.items() if upper[i] >= best_lower - tolerance}
+
+    if verbose:
+        print(f"after {rounds} rounds of {batch_size} worlds:")
+        for intervention in lower:
+            status = "kept" if intervention in remaining else "dropped"
+            print(f"  {intervention}: between {lower[intervention]} and {upper[intervention]} ({status})")
+    expected_utilities = {intervention: float((lower[intervention] + upper[intervention]) / 2)
+                          for intervention in remaining}
+    best = max(expected_utilities.values(), default=None)
+    return {intervention: best if value >= best - tolerance else value
+            for intervention, value in expected_utilities.items()}
+
+
+def policy_search(model, intervention_node, utility_node, verbose=False):
+    """
+    Find the policy with the highest expected utility without enumerating every policy,
+    for factor graphs where the intervention node ranges over a PolicySpace and every
+    factor that uses it looks up the output of the policy for the factor's other causes.
+
+    We choose the output for one input at a time, in order, by branch and bound. For a
+    partially chosen policy, we search the possible worlds and sort them by the first input
+    they consult whose output has not been chosen yet. Each of those inputs gets a single
+    output in any completion of the policy, so we add up, for each input and each output
+    it could have, the utility of the worlds that consult it first, taking whichever output
+    is best for any input those worlds consult later. The bound is the utility of the
+    worlds that consult no such input, plus the best total for each input. When every
+    world consults at most one input whose output is not chosen yet, the bound is exactly
+    the expected utility of the best completion, so a problem whose inputs do not interact
+    is solved without branching at all. Taking the best output for each input also gives
+    a completion of the policy, whose expected utility is the best so far to start with.
+
+    Unlike the other backends, this only reports the expected utility of the best policy.
+    Among policies with equal expected utility it picks the one listed first.
+    """
+    policies = model.nodes[intervention_node]
+    if not isinstance(policies, PolicySpace):
+        raise Exception(f"policy search requires {intervention_node} to range over a PolicySpace")
+    lookups = [factor for factor in model.factors if intervention_node in factor.scope]
+    for factor in lookups:
+        if factor.function is None or factor.causes[:1] != [intervention_node]:
+            raise Exception(f"factor for {factor.consequence} does not look up {intervention_node}")
+
+    # factors with no consequence, such as observations, may only weigh nodes that the
+    # policy cannot affect, so that they weigh every policy's worlds by the same total
+    determined = {factor.consequence for factor in lookups}
+    causes = {factor.consequence: factor.causes for factor in model.factors if factor.consequence is not None}
+    for node in model.topological_order():
+        if determined.intersection(causes.get(node, ())):
+            determined.add(node)
+    observations = [factor for factor in model.factors if factor.consequence is None]
+    if any(determined.intersection(factor.causes) for factor in observations):
+        raise Exception("policy search does not support observations of nodes that the policy affects")
+    total = 1.
+    if observations:
+        upstream = FactorGraph({n: v for n, v in model.nodes.items() if n != intervention_node and n not in determined},
+                               [factor for factor in model.factors if factor not in lookups
+                                and factor.consequence not in determined])
+        total = float(upstream.marginal([]))
+        if total == 0:
+            raise Exception("policy search requires the observations to have nonzero probability")
+
+    # the rest of the graph, in which the nodes that the policy determines are left free
+    rest = FactorGraph({n: v for n, v in model.nodes.items() if n != intervention_node},
+                       [factor for factor in model.factors if factor not in lookups])
+    axes, domains, positions, order, deterministic, checks = _search_steps(
+        rest, [node for node in model.topological_order() if node != intervention_node])
+    step_of_axis = {axis: step for step, axis in enumerate(order)}
+    utility_axis = axes[utility_node]
+
+    lookup_inputs = [None] * len(order)
+    for factor in lookups:
+        lookup_inputs[step_of_axis[axes[factor.consequence]]] = [axes[n] for n in factor.causes[1:]]
+
+    codes = [None] * len(domains)
+    evaluations = 0
+    profile = profiling.current
+    num_inputs = len(policies.input_space)
+    num_outputs = len(policies.output_space)
+    # bounds closer together than this are considered equal
+    tolerance = 1e-9 * max(1., float(np.abs(np.array(domains[utility_axis], dtype=float)).max(initial=0.)))
+
+    def bound(chosen):
+        # an upper bound on the expected utility of any policy whose first outputs are
+        # CHOSEN, together with the completion of CHOSEN that takes the best output for
+        # each input
+        nonlocal evaluations
+        evaluations += 1
+        grouped = np.zeros((num_inputs, num_outputs))
+        # the outputs assumed so far, in the current world, for inputs not in CHOSEN
+        assumed = {}
+
+        def visit(step, prob, first):
+            if step == len(order):
+                if profile is not None:
+                    profile.add_worlds(1, 1)
+                return prob * domains[utility_axis][codes[utility_axis]]
+            axis = order[step]
+            free = None
+            if lookup_inputs[step] is not None:
+                entry = policies.input_index[tuple(domains[a][codes[a]] for a in lookup_inputs[step])]
+                if entry < len(chosen):
+                    outputs = [chosen[entry]]
+                elif entry in assumed:
+                    outputs = [assumed[entry]]
+                else:
+                    free = entry
+                    outputs = range(num_outputs)
+                candidates = [positions[axis][policies.output_space[output]] for output in outputs]
+            elif deterministic[step] is not None:
+                function, cause_axes = deterministic[step]
+                value = function(*(domains[a][codes[a]] for a in cause_axes))
+                candidates = [positions[axis][value]] if value in positions[axis] else []
+            else:
+                candidates = range(len(domains[axis]))
+            values = []
+            for i, code in enumerate(candidates):
+                codes[axis] = code
+                if free is not None:
+                    assumed[free] = i
+                p = prob
+                for scope_axes, probability in checks[step]:
+                    p *= probability(tuple(codes[a] for a in scope_axes))
+                value = 0.
+                if p != 0:
+                    value = visit(step + 1, p, free if first is None else first)
+                elif profile is not None:
+                    profile.add_worlds(1, 0)
+                if free is not None and first is None:
+                    grouped[free, i] += value
+                values.append(value)
+            if free is None:
+                return sum(values)
+            del assumed[free]
+            # the worlds that consult FREE first are counted in GROUPED instead
+            return 0. if first is None else max(values)
+
+        value = visit(0, 1., None) + grouped.max(axis=1).sum()
+        completion = tuple(chosen) + tuple(
+            int(np.argmax(grouped[entry] >= grouped[entry].max() - tolerance))
+            for entry in range(len(chosen), num_inputs))
+        return value, completion
+
+    def better(choice, value):
+        # whether a policy or partial policy could replace the best policy found so far
+        if value > best_value + tolerance:
+            return True
+        return value >= best_value - tolerance and choice <= best_choice[:len(choice)]
+
+    # start from the completion favoured by the bound for no outputs chosen at all
+    _, best_choice = bound(())
+    best_value, _ = bound(best_choice)
+
+    # then search for the best policy, trying the most promising outputs first and
+    # skipping any branch that cannot beat the best so far
+    def branch(prefix):
+        nonlocal best_choice, best_value
+        children = []
+        for output in range(num_outputs):
+            choice = prefix + (output,)
+            children.append((bound(choice)[0], choice))
+        children.sort(key=lambda child: -child[0])
+        for value, choice in children:
+            if not better(choice, value):
+                continue
+            if len(choice) == num_inputs:
+                best_choice, best_value = choice, value
+            else:
+                branch(choice)
+
+    branch(())
+    best_policy = tuple(policies.output_space[output] for output in best_choice)
+    if verbose:
+        print(f"evaluated {evaluations} bounds while searching {len(policies)} policies")
+    return {best_policy: float(best_value / total)}
+
+
+def print_worlds(model, codes, prob):
+    """
+    Print the possible worlds in one chunk that have nonzero probability. CODES has one row
+    per world and one column per node.
+    """
+    import pandas as pd
+    nonzero = prob != 0
+    worlds = pd.DataFrame({
+        node: [values[code] for code in codes[nonzero, axis]]
+        for axis, (node, values) in enumerate(model.nodes.items())})
+    worlds['prob'] = prob[nonzero]
+    if len(worlds):
+        print(worlds)
+
+
+# junction trees built by the junction_tree backend, keyed by the fingerprint of the factor
+# graph they were built from together with the nodes they were built to query
+_junction_trees = {}
+
+
+def reset_caches(make_cache=dict):
+    """
+    Forget every junction tree built so far, and keep later ones in a new cache made by
+    calling MAKE_CACHE, which may return any mapping with the same methods as a dict.
+    """
+    global _junction_trees
+    _junction_trees = make_cache()
+
+
+def junction_tree(model, intervention_node, utility_node, verbose=False):
+    """
+    Compute expected utilities from the joint distribution of the intervention node and
+    the utility node, which we read off a calibrated junction tree (see calibrated_tree).
+    """
+    tree = calibrated_tree(model, [intervention_node, utility_node])
+    joint = tree.query([intervention_node, utility_node])
+    if verbose:
+        print("CLIQUES:")
+        for clique in tree.cliques:
+            print(f"  {clique}")
+        print(f"{tree.recomputed} messages computed so far")
+    return expectations_from_joint(model, intervention_node, utility_node, joint)
+
+
+def calibrated_tree(model, query):
+    """
+    Get a calibrated junction tree for MODEL in which the nodes in QUERY share a clique.
+    Trees are kept for the rest of the process and looked up by the fingerprint of the
+    factor graph, so asking about the same graph again reuses the calibrated tree, while a
+    graph whose factors have been changed by a theory's surgery gets a tree of its own.
+    Queries with evidence about the observed nodes can then be answered from the same tree
+    rather than from a tree for each conditioned graph.
+    """
+    key = (model.fingerprint(), tuple(query))
+    if key not in _junction_trees:
+        _junction_trees[key] = JunctionTree(model, query=query)
+    return _junction_trees[key]
+
+
+def lifted(model, intervention_node, utility_node, verbose=False):
+    """
+    Compute expected utilities for factor graphs containing many interchangeable copies of
+    something, such as copies of the agent, by reasoning about how many copies take each
+    value rather than about which copies take which value.
+
+    This applies when the utility node is the consequence of a symmetric factor (see
+    Factor.symmetric) and no other factor depends on the utility node. The graph may also
+    contain symmetric factors with no consequence, which constrain how many of their
+    causes take each value, such as the number of rooms of each color in
+    problems.build_many_rooms. We count the causes of each of these symmetric factors.
+    Only factors built with Factor.symmetric are treated this way: we do not work out
+    which nodes are interchangeable from the rest of the graph, such as from the logical
+    identity nodes, since that would mean tabulating the very factors that are too large
+    to tabulate. A problem with interchangeable copies must therefore build the factors
+    over all of the copies as symmetric factors for this backend to apply.
+
+    With the value of the intervention node fixed, we split the rest of the graph, apart
+    from the symmetric factors, into parts that share no factors, and each part may
+    contain at most one cause of each symmetric factor. For each part we compute the joint
+    distribution of its causes given the intervention, and parts that are the same as one
+    another up to the names of their nodes form a class whose distribution is computed
+    only once. The number of copies in each class whose causes take each combination of
+    values then follows a multinomial distribution, so the cost grows with the number of
+    ways of dividing the copies among values rather than exponentially with the number of
+    copies. Finally we weigh each way of dividing the causes of each symmetric factor by
+    the constraints and read off the utility.
+    """
+    symmetric = next((f for f in model.factors if f.consequence == utility_node), None)
+    if symmetric is None or symmetric.conditional_of_counts is None:
+        raise Exception(f"lifted inference requires {utility_node} to be the consequence of a symmetric factor")
+    constraints = [f for f in model.factors if f.consequence is None and f.conditional_of_counts is not None]
+    counted = [symmetric] + constraints
+    others = [f for f in model.factors if all(f is not c for c in counted)]
+    if any(utility_node in f.scope for f in others + constraints):
+        raise Exception(f"lifted inference requires that no factor other than its own uses {utility_node}")
+
+    # the possible values shared by the causes of each symmetric factor
+    values = []
+    for factor in counted:
+        values.append(list(model.nodes[factor.causes[0]]) if factor.causes else [])
+        for cause in factor.causes:
+            if list(model.nodes[cause]) != values[-1]:
+                raise Exception(f"lifted inference requires the causes of each symmetric factor to share their "
+                                f"possible values, but {cause} does not")
+
+    # group the nodes that are connected by factors, leaving out the intervention node
+    # since its value is always known
+    component = {node: node for node in model.nodes if node not in (intervention_node, utility_node)}
+
+    def root(node):
+        while component[node] != node:
+            node = component[node]
+        return node
+
+    for factor in others:
+        rest = [n for n in factor.scope if n != intervention_node]
+        for node in rest[1:]:
+            component[root(node)] = root(rest[0])
+
+    parts = collections.defaultdict(lambda: ([], []))
+    weight = np.ones(len(model.nodes[intervention_node]))
+    for node in component:
+        parts[root(node)][0].append(node)
+    for factor in others:
+        rest = [n for n in factor.scope if n != intervention_node]
+        if rest:
+            parts[root(rest[0])][1].append(factor)
+        else:
+            # a factor of the intervention node alone weighs each intervention value
+            weight *= FactorGraph({intervention_node: model.nodes[intervention_node]}, [factor]).marginal(
+                [intervention_node])
+
+    # compute the joint distribution of the causes in each part given the intervention,
+    # once per class of parts, together with the symmetric factors those causes belong to
+    classes = {}
+    for part_nodes, part_factors in parts.values():
+        linked = [[c for c in factor.causes if c in part_nodes] for factor in counted]
+        if any(len(causes) > 1 for causes in linked):
+            copies = next(causes for causes in linked if len(causes) > 1)
+            raise Exception(f"lifted inference requires {copies} to be independent given {intervention_node}")
+        key = _part_fingerprint(model, part_nodes, part_factors, intervention_node, linked)
+        if key in classes:
+            classes[key][0] += 1
+            continue
+        part = FactorGraph({node: model.nodes[node] for node in [intervention_node] + part_nodes}, part_factors)
+        which = [k for k, causes in enumerate(linked) if causes]
+        marginal = part.marginal([intervention_node] + [linked[k][0] for k in which])
+        if which:
+            classes[key] = [1, marginal, which]
+        else:
+            weight *= marginal
+    which = [k for k, factor in enumerate(counted) if intervention_node in factor.causes]
+    if which:
+        if any(list(model.nodes[intervention_node]) != values[k] for k in which):
+            raise Exception(f"lifted inference requires the causes of each symmetric factor to share their "
+                            f"possible values, but {intervention_node} does not")
+        # the intervention node takes its own value with certainty
+        marginal = np.zeros((len(model.nodes[intervention_node]),) * (1 + len(which)))
+        for code in range(len(model.nodes[intervention_node])):
+            marginal[(code,) * (1 + len(which))] = 1.
+        classes["intervention"] = [1, marginal, which]
+
+    # combine the classes into a distribution over the number of causes of each symmetric
+    # factor taking each value
+    counts = {tuple((0,) * len(v) for v in values): weight}
+    for size, marginal, which in classes.values():
+        cells = list(itertools.product(*(range(len(values[k])) for k in which)))
+        cell_probs = marginal.reshape(marginal.shape[0], -1)
+        combined = collections.defaultdict(float)
+        for division in count_vectors(size, len(cells)):
+            coefficient = math.factorial(size) / math.prod(math.factorial(c) for c in division)
+            prob = coefficient * np.prod(cell_probs ** np.array(division), axis=1)
+            added = [[0] * len(v) for v in values]
+            for cell, number in zip(cells, division):
+                for k, code in zip(which, cell):
+                    added[k][code] += number
+            for before, p in counts.items():
+                combined[tuple(tuple(a + b for a, b in zip(*pair)) for pair in zip(before, added))] += p * prob
+        counts = combined
+
+    tables = [factor.to_count_table(model.nodes) for factor in counted]
+    columns = [{division: i for i, division in enumerate(count_vectors(len(factor.causes), len(v)))}
+               for factor, v in zip(counted, values)]
+    joint = np.zeros((len(model.nodes[intervention_node]), len(model.nodes[utility_node])))
+    for divisions, p in counts.items():
+        allowed = math.prod(table[0, column[division]]
+                            for table, column, division in zip(tables[1:], columns[1:], divisions[1:]))
+        if allowed != 0:
+            joint += allowed * np.outer(p, tables[0][:, columns[0][divisions[0]]])
+    if verbose:
+        print(f"{len(symmetric.causes)} copies in {len(classes)} classes, {len(counts)} ways to divide them")
+    return expectations_from_joint(model, intervention_node, utility_node, joint)
+
+
+def _part_fingerprint(model, part_nodes, part_factors, intervention_node, linked):
+    """
+    Compute a digest that identifies a part of a factor graph up to the names of its nodes,
+    so that two parts with the same digest give the same joint distribution for their
+    causes of symmetric factors. LINKED lists the part's causes of each symmetric factor.
+    """
+    labels = {intervention_node: "intervention"}
+    for k, causes in enumerate(linked):
+        labels.update((cause, f"cause {k}") for cause in causes)
+    digest = hashlib.sha256()
+    for factor in part_factors:
+        for node in factor.scope:
+            labels.setdefault(node, len(labels))
+        digest.update(repr(([labels[n] for n in factor.scope], factor.consequence is None)).encode())
+        digest.update(factor.to_table(model.nodes).tobytes())
+    for node in part_nodes:
+        labels.setdefault(node, len(labels))
+    digest.update(repr(sorted((str(labels[n]), list(model.nodes[n])) for n in part_nodes)).encode())
+    return digest.hexdigest()
+
+
+def sampling(model, intervention_node, utility_node, verbose=False, seed=None, batch_size=10000,
+             min_samples=10000, max_samples=200000, confidence=0.95):
+    """
+    Estimate expected utilities by sampling possible worlds, for factor graphs too large
+    for any exact method. See estimate_expected_utilities for how the sampling works. With
+    verbose output we print a confidence interval and an effective sample size for each
+    intervention value.
+    """
+    estimates = estimate_expected_utilities(model, intervention_node, utility_node, seed=seed,
+                                            batch_size=batch_size, min_samples=min_samples,
+                                            max_samples=max_samples, confidence=confidence)
+    if verbose:
+        for intervention, estimate in estimates.items():
+            print(f"{intervention}: {estimate}")
+    return {intervention: estimate.mean for intervention, estimate in estimates.items()}
+
+
+class Estimate(object):
+    """
+    An estimate of an expected utility from weighted samples, with a confidence interval
+    from LOWER to UPPER. The effective sample size is the number of unweighted samples
+    that would give an estimate of the same precision.
+    """
+    def __init__(self, mean, lower, upper, effective_sample_size, samples):
+        self.mean = mean
+        self.lower = lower
+        self.upper = upper
+        self.effective_sample_size = effective_sample_size
+        self.samples = samples
+
+    def __repr__(self):
+        return (f"{self.mean:.6g} in [{self.lower:.6g}, {self.upper:.6g}] "
+                f"from {self.samples} samples (effective sample size {self.effective_sample_size:.1f})")
+
+
+def estimate_expected_utilities(model, intervention_node, utility_node, seed=None, batch_size=10000,
+                                min_samples=10000, max_samples=200000, confidence=0.95):
+    """
+    Estimate the expected utility for each intervention value by likelihood weighting.
+    For each intervention value we repeatedly sample a possible world by visiting the
+    nodes in causal order and drawing each one from its conditional probability given the
+    values already drawn for its causes. The intervention node is not drawn but fixed to
+    the value in question, and factors that describe observations are not drawn from
+    either. Instead, each sample is weighted by the probability those factors assign to it.
+
+    Samples are drawn in batches, alternating between intervention values, and we stop
+    early once the confidence interval for one intervention value lies entirely above the
+    intervals of all the others. Returns a dict from intervention value to Estimate,
+    omitting values that never received any weight. Passing the same SEED gives the same
+    estimates.
+    """
+    rng = np.random.default_rng(seed)
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    axes = {node: axis for axis, node in enumerate(model.nodes)}
+    domains = list(model.nodes.values())
+    utilities = np.array(model.nodes[utility_node], dtype=float)
+    conditionals = {}
+    observations = []
+    for factor, (scope, table) in zip(model.factors, model.compile()):
+        if factor.consequence is None:
+            observations.append(([axes[n] for n in scope], table))
+        else:
+            conditionals[factor.consequence] = ([axes[n] for n in factor.causes], table)
+    order = model.topological_order()
+
+    def draw(intervention_code):
+        codes = [None] * len(domains)
+        weight = np.ones(batch_size)
+        for node in order:
+            axis = axes[node]
+            if node == intervention_node:
+                codes[axis] = np.full(batch_size, intervention_code)
+                if node in conditionals:
+                    cause_axes, table = conditionals[node]
+                    weight *= table[(codes[axis],) + tuple(codes[a] for a in cause_axes)]
+            elif node in conditionals and isinstance(conditionals[node][1], DeterministicTable):
+                # the causes determine the value, and a value that is not possible gets no weight
+                cause_axes, table = conditionals[node]
+                looked_up = table.codes[tuple(codes[a] for a in cause_axes)] * np.ones(batch_size, dtype=int)
+                weight *= looked_up >= 0
+                codes[axis] = np.maximum(looked_up, 0)
+            elif node in conditionals:
+                cause_axes, table = conditionals[node]
+                probs = table[(slice(None),) + tuple(codes[a] for a in cause_axes)]
+                cumulative = np.cumsum(probs.reshape(len(domains[axis]), -1) * np.ones(batch_size), axis=0)
+                weight *= cumulative[-1]
+                threshold = rng.random(batch_size) * cumulative[-1]
+                codes[axis] = np.minimum((cumulative < threshold).sum(axis=0), len(domains[axis]) - 1)
+            else:
+                codes[axis] = rng.integers(len(domains[axis]), size=batch_size)
+        for scope, table in observations:
+            weight *= table[tuple(codes[a] for a in scope)]
+        return weight, utilities[codes[axes[utility_node]]]
+
+    # running sums of w, w*u, w*u*u, and w*w for each intervention value
+    sums = np.zeros((len(domains[axes[intervention_node]]), 4))
+    samples = 0
+    while samples < max_samples:
+        for code in range(len(sums)):
+            weight, utility = draw(code)
+            sums[code] += [weight.sum(), (weight * utility).sum(), (weight * utility * utility).sum(),
+                           (weight * weight).sum()]
+            if profiling.current is not None:
+                profiling.current.add_worlds(batch_size, np.count_nonzero(weight))
+                profiling.current.add_state_space(batch_size)
+        samples += batch_size
+        estimates = _estimates(model, intervention_node, sums, samples, z)
+        if samples >= min_samples and len(estimates) > 0:
+            best = max(estimates, key=lambda i: estimates[i].mean)
+            if all(estimates[best].lower > e.upper for i, e in estimates.items() if i != best):
+                break
+    return estimates
+
+
+def _estimates(model, intervention_node, sums, samples, z):
+    estimates = {}
+    for intervention, (total, weighted, squared, weight_squared) in zip(model.nodes[intervention_node], sums):
+        if total == 0:
+            continue
+        mean = weighted / total
+        variance = max(squared / total - mean * mean, 0.)
+        effective_sample_size = total * total / weight_squared
+        margin = z * math.sqrt(variance / effective_sample_size)
+        estimates[intervention] = Estimate(float(mean), float(mean - margin), float(mean + margin),
+                                           float(effective_sample_size), samples)
+    return estimates
+
+
+def expectations_from_joint(model, intervention_node, utility_node, joint):
+    """
+    Given an array JOINT whose rows are indexed by intervention value and whose columns are
+    indexed by utility value, compute the expected utility for each intervention value.
+    """
+    utilities = np.array(model.nodes[utility_node], dtype=float)
+    return expectations_from_sums(model, intervention_node, joint @ utilities, joint.sum(axis=1))
+
+
+def expectations_from_sums(model, intervention_node, weighted, total):
+    """
+    Given, for each intervention value, the sum of probability times utility (WEIGHTED) and
+    the sum of probability (TOTAL) over the worlds with that intervention value, compute the
+    expected utility for each intervention value.
+    """
+    with profiling.phase("aggregation"):
+        return {
+            intervention: float(w / t)
+            for intervention, w, t in zip(model.nodes[intervention_node], weighted, total)
+            if t != 0
+        }
+
+
+BACKENDS = {
+    "enumeration": enumeration,
+    "elimination": variable_elimination,
+    "streaming": streaming,
+    "search": search,
+    "policy_search": policy_search,
+    "anytime": anytime,
+    "junction_tree": junction_tree,
+    "lifted": lifted,
+    "sampling": sampling,
+}
@@ -0,0 +1,153 @@
+import numpy as np
+
+from factorgraph import contract
+
+
+class JunctionTree(object):
+    """
+    A junction tree (also called a clique tree) groups the nodes of a factor graph into
+    overlapping cliques arranged in a tree, such that every factor fits inside some clique
+    and the cliques containing any given node are connected to each other. Passing a
+    message along each edge of the tree in each direction then gives the joint
+    distribution of the nodes in any one clique.
+
+    The tree is calibrated when it is constructed, meaning that every message is computed
+    once with no evidence. Later queries may fix some nodes to observed values. Each
+    message is cached according to the evidence on the side of the tree it came from, so
+    a query only computes the messages whose side of the tree has evidence that has not
+    been seen before.
+
+    The nodes in QUERY are guaranteed to share a clique, so their joint distribution can
+    be read off directly. A query for nodes that do not share a clique raises an exception.
+    """
+    def __init__(self, model, query=()):
+        self.nodes = model.nodes
+        self.recomputed = 0
+
+        # eliminating the nodes one at a time tells us which cliques we need
+        neighbours = {node: set() for node in model.nodes}
+        for scope in [factor.scope for factor in model.factors] + [list(query)]:
+            for node in scope:
+                neighbours[node].update(n for n in scope if n != node)
+        cliques = []
+        for node in model.elimination_order(connect=[query]):
+            adjacent = neighbours.pop(node)
+            clique = adjacent | {node}
+            if not any(clique <= c for c in cliques):
+                cliques.append(clique)
+            for a in adjacent:
+                neighbours[a].discard(node)
+                neighbours[a].update(adjacent - {a})
+        self.cliques = [[n for n in model.nodes if n in clique] for clique in cliques]
+
+        # connect the cliques by a maximum spanning tree, weighted by the size of the
+        # overlap between cliques, which gives a tree with the property described above
+        self.neighbours = {i: [] for i in range(len(self.cliques))}
+        component = list(range(len(self.cliques)))
+
+        def root(i):
+            while component[i] != i:
+                i = component[i]
+            return i
+
+        candidates = sorted(
+            ((i, j) for i in range(len(cliques)) for j in range(i + 1, len(cliques))),
+            key=lambda edge: -len(cliques[edge[0]] & cliques[edge[1]]))
+        for i, j in candidates:
+            if root(i) != root(j):
+                component[root(i)] = root(j)
+                self.neighbours[i].append(j)
+                self.neighbours[j].append(i)
+
+        # for each direction along each edge, the nodes shared by the two cliques and the
+        # nodes in all the cliques on the sending side
+        self._separators = {}
+        self._behind = {}
+        for i in self.neighbours:
+            for j in self.neighbours[i]:
+                self._separators[i, j] = [n for n in self.cliques[i] if n in self.cliques[j]]
+                self._behind[i, j] = self._nodes_behind(i, j)
+
+        # multiply each factor into the first clique that contains all of its nodes
+        assigned = {i: [([n], np.ones(len(model.nodes[n]))) for n in clique] for i, clique in enumerate(self.cliques)}
+        for scope, table in model.compile():
+            home = next(i for i, clique in enumerate(self.cliques) if set(scope) <= set(clique))
+            assigned[home].append((scope, table))
+        self._potentials = [contract(assigned[i], clique) for i, clique in enumerate(self.cliques)]
+
+        # evidence about a node is entered in the first clique that contains it
+        self._home = {}
+        for i, clique in enumerate(self.cliques):
+            for node in clique:
+                self._home.setdefault(node, i)
+
+        self._messages = {edge: {} for edge in self._separators}
+        self.calibrate()
+
+    def _nodes_behind(self, i, j):
+        nodes = set()
+        stack = [(i, j)]
+        while stack:
+            clique, came_from = stack.pop()
+            nodes.update(self.cliques[clique])
+            stack.extend((k, clique) for k in self.neighbours[clique] if k != came_from)
+        return nodes
+
+    def calibrate(self, evidence=None):
+        """
+        Compute the message along each edge of the tree in each direction.
+        """
+        for i, j in self._separators:
+            self._message(i, j, evidence or {})
+
+    def query(self, nodes, evidence=None):
+        """
+        Compute the joint probability of NODES together with the evidence, which is a map from
+        node names to observed values. The result is an array with one axis per node in NODES,
+        indexed by position within that node's list of possible values.
+        """
+        evidence = evidence or {}
+        for node, value in evidence.items():
+            if node not in self._home:
+                raise Exception(f"cannot observe {node}={value!r}: no such node")
+            if value not in self.nodes[node]:
+                raise Exception(f"cannot observe {node}={value!r}: expected one of {self.nodes[node]}")
+        home = next((i for i, clique in enumerate(self.cliques) if set(nodes) <= set(clique)), None)
+        if home is None:
+            raise Exception(f"{list(nodes)} do not share a clique; pass them as the query when building the tree")
+        potentials = [(self.cliques[home], self._potential(home, evidence))]
+        for k in self.neighbours[home]:
+            potentials.append((self._separators[k, home], self._message(k, home, evidence)))
+        return contract(potentials, list(nodes))
+
+    def _potential(self, i, evidence):
+        """
+        The product of the factors assigned to clique I, with the evidence about the nodes
+        whose home is clique I entered as indicators.
+        """
+        indicators = []
+        for node, value in evidence.items():
+            if self._home[node] == i:
+                indicator = np.zeros(len(self.nodes[node]))
+                indicator[self.nodes[node].index(value)] = 1.
+                indicators.append(([node], indicator))
+        if not indicators:
+            return self._potentials[i]
+        return contract([(self.cliques[i], self._potentials[i])] + indicators, self.cliques[i])
+
+    def _message(self, i, j, evidence):
+        """
+        The message from clique I to clique J, which summarizes everything on I's side of the
+        tree as a function of the nodes that I and J share.
+        """
+        relevant = frozenset((n, v) for n, v in evidence.items() if n in self._behind[i, j])
+        if relevant in self._messages[i, j]:
+            return self._messages[i, j][relevant]
+        self.recomputed += 1
+        potentials = [(self.cliques[i], self._potential(i, evidence))]
+        for k in self.neighbours[i]:
+            if k != j:
+                potentials.append((self._separators[k, i], self._message(k, i, evidence)))
+        message = contract(potentials, self._separators[i, j])
+        self._messages[i, j][relevant] = message
+        return message
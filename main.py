@@ -1,46 +1,149 @@
 import argparse
+import contextlib
+import json
+import sys
 
 import problems
 import theories
 import decide
+import inference
+import batch
+import profiling
+
+
+def add_backend_arguments(parser):
+    parser.add_argument("--backend", choices=list(inference.BACKENDS), default="enumeration")
+    parser.add_argument("--prune", action="store_true", default=False,
+                        help="remove nodes that cannot affect the expected utility before inference")
+    parser.add_argument("--chunk_size", type=int, help="number of worlds per chunk for the streaming backend")
+    parser.add_argument("--workers", type=int, help="number of processes for the streaming backend")
+    parser.add_argument("--seed", type=int, help="random seed for the sampling backend")
+    parser.add_argument("--batch_size", type=int, help="number of worlds per batch for the sampling and anytime backends")
+    parser.add_argument("--cache_dir", help="directory in which to save built problems, so later runs can load them")
+
+
+def backend_options(args):
+    """
+    Collect any backend-specific options that were given on the command line.
+    """
+    options = {"prune": args.prune}
+    if args.chunk_size is not None:
+        options["chunk_size"] = args.chunk_size
+    if args.workers is not None:
+        options["workers"] = args.workers
+    if args.seed is not None:
+        options["seed"] = args.seed
+    if args.batch_size is not None:
+        options["batch_size"] = args.batch_size
+    return options
+
 
 def main():
+    if sys.argv[1:2] == ["batch"]:
+        batch_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["serve"]:
+        serve_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("decision_theory", choices=["EDT", "CDT", "TDT", "UDT1.1", "RDT"])
-    parser.add_argument("decision_problem", choices=["newcomb", "redroom", "blueroom"])
+    parser.add_argument("decision_theory", choices=list(theories.THEORIES))
+    parser.add_argument("decision_problem", choices=list(problems.PROBLEMS))
     parser.add_argument("--verbose", action="store_true", default=False)
     parser.add_argument("--initial_verbose", action="store_true", default=False)
     parser.add_argument("--modified_verbose", action="store_true", default=False)
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="print where the time was spent and how many worlds were considered")
+    parser.add_argument("--profile_output", help="file to write the profile to as JSON")
+    parser.add_argument("--all_observations", action="store_true", default=False,
+                        help="decide under every possible value of the observed nodes at once")
+    add_backend_arguments(parser)
     args = parser.parse_args()
 
-    if args.decision_theory.upper() == "EDT":
-        theory = theories.evidential_decision_theory
-    elif args.decision_theory.upper() == "CDT":
-        theory = theories.causal_decision_theory
-    elif args.decision_theory.upper() == "TDT":
-        theory = theories.timeless_decision_theory
-    elif args.decision_theory.upper() == "UDT1.1":
-        theory = theories.updateless_decision_theory_11
-    elif args.decision_theory.upper() == "RDT":
-        theory = theories.recursive_decision_theory
-    else:
-        print(f"unknown decision theory: {args.decision_theory}")
-        return
+    theory = theories.THEORIES[args.decision_theory]
+    world_model, observations, utility_node, physical_identity, logical_identity = batch.build(args.decision_problem, args.cache_dir)
 
-    if args.decision_problem == "newcomb":
-        world_model, observations, utility_node, physical_identity, logical_identity = problems.build_newcomb()
-    elif args.decision_problem == "redroom":
-        world_model, observations, utility_node, physical_identity, logical_identity = problems.build_red_room_blue_room("red")
-    elif args.decision_problem == "blueroom":
-        world_model, observations, utility_node, physical_identity, logical_identity = problems.build_red_room_blue_room("blue")
+    with profiling.profiled() if args.profile or args.profile_output else contextlib.nullcontext() as profile:
+        if args.all_observations:
+            rows = decide.decide_all_observations(theory, world_model, list(observations), utility_node, physical_identity,
+                                                  logical_identity, backend=args.backend, **backend_options(args))
+        else:
+            output, formatted_output = decide.decide(theory, world_model, observations, utility_node, physical_identity, logical_identity, args,
+                                                    backend=args.backend, **backend_options(args))
+    if args.all_observations:
+        for row in rows:
+            if args.verbose:
+                print(f"{row['observations']}: expected utilities {row['expected_utilities']}")
+            print(f"{row['observations']}: {row['formatted_output']}")
     else:
-        print(f"unknown decision theory: {args.decision_theory}")
-        return
+        if args.verbose:
+            print(output)
+        print(formatted_output)
+    if args.profile:
+        print(profile)
+    if args.profile_output:
+        with open(args.profile_output, "w") as f:
+            json.dump(profile.to_dict(), f, indent=2)
+
+
+def batch_main(argv):
+    """
+    Run many decisions in one process. Jobs are given as THEORY:PROBLEM on the command line,
+    or as lines of JSON like {"theory": "TDT", "problem": "redroom", "observations": {...}}
+    in a file. With no jobs, every theory is run on every problem.
+    """
+    parser = argparse.ArgumentParser(prog="main.py batch")
+    parser.add_argument("jobs", nargs="*", metavar="THEORY:PROBLEM")
+    parser.add_argument("--jobs_file", help="file with one JSON job per line")
+    add_backend_arguments(parser)
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for job in args.jobs:
+        theory, _, problem = job.partition(":")
+        jobs.append((theory, problem, None))
+    if args.jobs_file:
+        with open(args.jobs_file) as f:
+            for line in f:
+                if line.strip():
+                    job = json.loads(line)
+                    jobs.append((job["theory"], job["problem"], job.get("observations")))
+    if not jobs:
+        jobs = batch.all_jobs()
+
+    for theory, problem, _ in jobs:
+        if theory not in theories.THEORIES:
+            parser.error(f"unknown decision theory: {theory}")
+        if problem not in problems.PROBLEMS:
+            parser.error(f"unknown decision problem: {problem}")
 
-    output, formatted_output = decide.decide(theory, world_model, observations, utility_node, physical_identity, logical_identity, args)
-    if args.verbose:
-        print(output)
-    print(formatted_output)
+    print(batch.format_table(batch.run(jobs, backend=args.backend, cache_dir=args.cache_dir, **backend_options(args))))
+
+
+def serve_main(argv):
+    """
+    Answer decisions as lines of JSON, read from stdin or from clients of a Unix socket,
+    until stopped. See service.py for the format of requests and responses.
+    """
+    parser = argparse.ArgumentParser(prog="main.py serve")
+    parser.add_argument("--socket", help="path of a Unix socket to listen on instead of reading stdin")
+    parser.add_argument("--cache_size", type=int, default=1024,
+                        help="number of problems, results and junction trees to keep in memory")
+    add_backend_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # the service and asyncio are only needed here, so we don't make every other command
+    # wait for them to be imported
+    import asyncio
+    import service
+    server = service.Service(args.cache_size, args.cache_dir, backend=args.backend, **backend_options(args))
+    if args.socket:
+        try:
+            asyncio.run(service.serve_socket(server, args.socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        service.serve_stdio(server)
 
 
 if __name__ == "__main__":
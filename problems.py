@@ -185,3 +185,80 @@ def build_red_room_blue_room(observed_color):
 
     # return the full problem setup
     return world_model, observations, utility_node, physical_identity, logical_identity
+
+
+def build_many_rooms(num_copies, observed_color, colors=("red", "blue")):
+    """
+    Set up a version of the red room / blue room problem with NUM_COPIES copies of the
+    agent, where the agent observes that its own room is OBSERVED_COLOR.
+
+    The copies are divided among rooms of the COLORS as evenly as possible, with the
+    earlier colors getting one more room when the copies do not divide evenly, and the
+    copies are placed in those rooms in a random order. Each copy outputs one of two
+    possible messages, and the agent receives a reward for every pair of copies that choose
+    *differently* from one another. With two copies and the colors red and blue, this is
+    exactly build_red_room_blue_room: whichever color I see, my copy sees the other.
+
+    We give each room an independent uniform prior over the colors, together with a factor
+    that has no consequence and that rules out every assignment of colors to rooms that
+    does not have the right number of rooms of each color. Conditioned on that factor,
+    every order of the copies is equally likely. The copies are interchangeable, and both
+    that factor and the utility depend only on how many copies see each color or output
+    each message, so both are symmetric factors. This lets the "lifted" backend solve the
+    problem for many more copies than would fit in a table.
+    """
+
+    # the agent itself is copy 0, and the others are numbered from 1
+    rooms = ["color I see"] + [f"color copy {i} sees" for i in range(1, num_copies)]
+    actions = ["action I take"] + [f"action copy {i} takes" for i in range(1, num_copies)]
+    num_pairs = num_copies * (num_copies - 1) // 2
+    rooms_of_color = {color: num_copies // len(colors) + (i < num_copies % len(colors))
+                      for i, color in enumerate(colors)}
+
+    # first set up the names of the nodes and their possible values
+    nodes = {}
+    for room, action in zip(rooms, actions):
+        nodes[room] = list(colors)
+        nodes[action] = [1, 2]
+    nodes["utility"] = list(range(num_pairs + 1))
+
+    # the utility counts the pairs of copies whose actions differ
+    def pairs_that_differ(counts):
+        return num_pairs - sum(count * (count - 1) // 2 for count in counts.values())
+
+    # now set up the factors defining the relationships between these nodes
+    factors = []
+    for room, action in zip(rooms, actions):
+        factors.append(Factor.uniform(room, 1 / len(colors)))
+        factors.append(Factor.uniform_function_of(action, [room], 0.5))
+    factors.append(Factor.symmetric(None, rooms, lambda _, counts: float(
+        all(counts[color] == number for color, number in rooms_of_color.items()))))
+    factors.append(Factor.symmetric("utility", actions,
+                                    lambda utility, counts: float(utility == pairs_that_differ(counts))))
+
+    # create the factor graph
+    world_model = FactorGraph(nodes, factors)
+
+    # in this problem we observe the color of the room we are in
+    observations = {"color I see": observed_color}
+
+    # in this graph, utility always corresponds to the node labelled "utility"
+    utility_node = "utility"
+
+    # from a physical standpoint, our action corresponds to the node "action I take"
+    physical_identity = "action I take"
+
+    # from a logical standpoint, our decision algorithm determines the actions of every copy
+    logical_identity = actions
+
+    # return the full problem setup
+    return world_model, observations, utility_node, physical_identity, logical_identity
+
+
+# the decision problems in this file, by the names used on the command line
+PROBLEMS = {
+    "newcomb": build_newcomb,
+    "redroom": lambda: build_red_room_blue_room("red"),
+    "blueroom": lambda: build_red_room_blue_room("blue"),
+    "manyrooms": lambda: build_many_rooms(4, "red"),
+}
@@ -0,0 +1,146 @@
+import contextlib
+import time
+
+# This file collects statistics about where decide() spends its time. Profiling is off
+# unless a Profile has been started with profiled(), and while it is off every place that
+# records statistics costs one check of the module variable `current`, which is None.
+#
+# The rest of the code records statistics like this:
+#
+#     with profiling.phase("evaluation"):
+#         ...
+#
+#     if profiling.current is not None:
+#         profiling.current.add_worlds(generated, kept)
+
+# the profile that statistics are currently being recorded into, or None
+current = None
+
+
+class FactorStats(object):
+    """
+    The number of times a factor's conditional probability was called, and the total time
+    spent in those calls, in seconds.
+    """
+    __slots__ = ("calls", "seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+
+
+class Profile(object):
+    """
+    Statistics about one or more calls to decide(). PHASES maps the name of each phase of
+    the work, such as "surgery" or "evaluation", to the time spent in it in seconds. Phases
+    may nest, for example when a theory calls decide() during its surgery, and the time
+    recorded for a phase excludes the time spent in the phases nested within it, so the
+    times add up to the total.
+
+    FACTORS maps a label for each factor to a FactorStats. Worlds are counted by the
+    inference backends: WORLDS_GENERATED is the number of possible worlds (or, for backends
+    that search, partial worlds) that were considered, WORLDS_PRUNED is the number of those
+    that were found to have zero probability, and WORLDS_KEPT is the rest. Backends that
+    never consider individual worlds, such as variable elimination, do not count any.
+    PEAK_STATE_SPACE is the largest number of entries in any table or batch of worlds that
+    was held in memory at once.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.factors = {}
+        self.worlds_generated = 0
+        self.worlds_pruned = 0
+        self.worlds_kept = 0
+        self.peak_state_space = 0
+        self._running = []
+
+    def add_worlds(self, generated, kept):
+        self.worlds_generated += int(generated)
+        self.worlds_kept += int(kept)
+        self.worlds_pruned += int(generated) - int(kept)
+
+    def add_factor_calls(self, factor, calls, seconds):
+        label = f"{factor.consequence or '(observation)'} <= {factor.causes}"
+        stats = self.factors.get(label)
+        if stats is None:
+            stats = self.factors[label] = FactorStats()
+        stats.calls += calls
+        stats.seconds += seconds
+
+    def add_state_space(self, size):
+        self.peak_state_space = max(self.peak_state_space, int(size))
+
+    def to_dict(self):
+        """
+        The statistics as a dict of plain values, suitable for writing as JSON.
+        """
+        return {
+            "phases": dict(self.phases),
+            "factors": {label: {"calls": stats.calls, "seconds": stats.seconds}
+                        for label, stats in self.factors.items()},
+            "worlds_generated": self.worlds_generated,
+            "worlds_pruned": self.worlds_pruned,
+            "worlds_kept": self.worlds_kept,
+            "peak_state_space": self.peak_state_space,
+        }
+
+    def __str__(self):
+        lines = ["PHASES:"]
+        for name, seconds in self.phases.items():
+            lines.append(f"  {name:20s} {seconds:.6f}s")
+        lines.append("FACTORS:")
+        for label, stats in sorted(self.factors.items(), key=lambda item: -item[1].seconds):
+            lines.append(f"  {label:40s} {stats.calls:10d} calls {stats.seconds:.6f}s")
+        lines.append(f"WORLDS: {self.worlds_generated} generated, {self.worlds_pruned} pruned, "
+                     f"{self.worlds_kept} kept")
+        lines.append(f"PEAK STATE SPACE: {self.peak_state_space}")
+        return "\n".join(lines)
+
+
+class _Phase(object):
+    __slots__ = ("profile", "name", "start", "nested")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.
+        self.start = time.perf_counter()
+        self.profile._running.append(self)
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.profile._running.pop()
+        if self.profile._running:
+            self.profile._running[-1].nested += elapsed
+        phases = self.profile.phases
+        phases[self.name] = phases.get(self.name, 0.) + elapsed - self.nested
+
+
+_not_profiling = contextlib.nullcontext()
+
+
+def phase(name):
+    """
+    A context manager that records the time spent within it as part of the phase called
+    NAME, or does nothing if profiling is off.
+    """
+    if current is None:
+        return _not_profiling
+    return _Phase(current, name)
+
+
+@contextlib.contextmanager
+def profiled():
+    """
+    Record statistics into a new Profile for the duration of a with block, and yield the
+    Profile. Whatever profile was being recorded into before is restored afterwards.
+    """
+    global current
+    previous = current
+    current = Profile()
+    try:
+        yield current
+    finally:
+        current = previous
@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import stat
+import sys
+import time
+
+import batch
+import decide
+import inference
+import problems
+import theories
+
+# This file answers decisions for other programs from one long-running process, so that
+# importing modules, building problems and tabulating factors happen once rather than
+# once per query. Requests and responses are lines of JSON. A request looks like
+#
+#     {"id": 7, "theory": "TDT", "problem": "redroom", "observations": {...}, "backend": "elimination"}
+#
+# where only the theory and problem are required, and any other key is passed to decide()
+# as a backend option. The response echoes the id, and gives either the output chosen
+# together with the time taken in seconds, or an error message.
+
+
+class LRUCache(collections.OrderedDict):
+    """
+    A dict that holds at most MAXSIZE entries, discarding the least recently used entry
+    when a new one is added. Looking up an entry counts as using it.
+    """
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        # OrderedDict.get does not go through __getitem__
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class Service(object):
+    """
+    Answers requests using caches that are kept for the lifetime of the service. Built
+    problems are kept here, and each keeps the tables of its factors once tabulated.
+    Results, attempts at counterfactual decisions and junction trees are kept in the caches
+    of decide.py and inference.py, which we replace by LRU caches of at most CACHE_SIZE
+    entries each (see their reset_caches()). Problems are loaded from CACHE_DIR if they were saved there before (see
+    storage.py). DEFAULTS gives the backend and backend options for requests that do not
+    specify their own.
+    """
+    def __init__(self, cache_size=1024, cache_dir=None, **defaults):
+        self.cache_dir = cache_dir
+        self.defaults = defaults
+        self.problems = LRUCache(cache_size)
+        decide.reset_caches(lambda: LRUCache(cache_size))
+        inference.reset_caches(lambda: LRUCache(cache_size))
+
+    def answer(self, request):
+        """
+        Compute the response to one request, given as a dict.
+        """
+        response = {"id": request.get("id")}
+        start = time.perf_counter()
+        try:
+            theory_name = request["theory"]
+            problem_name = request["problem"]
+            if theory_name not in theories.THEORIES:
+                raise Exception(f"unknown decision theory: {theory_name}")
+            if problem_name not in problems.PROBLEMS:
+                raise Exception(f"unknown decision problem: {problem_name}")
+            if problem_name not in self.problems:
+                self.problems[problem_name] = batch.build(problem_name, self.cache_dir)
+            world_model, observations, utility_node, physical_identity, logical_identity = self.problems[problem_name]
+            if request.get("observations") is not None:
+                observations = request["observations"]
+
+            options = dict(self.defaults)
+            options.update((k, v) for k, v in request.items() if k not in ("id", "theory", "problem", "observations"))
+            _, output = decide.decide(theories.THEORIES[theory_name], world_model, observations, utility_node,
+                                      physical_identity, logical_identity, **options)
+            response["output"] = output
+        except Exception as e:
+            response["error"] = str(e)
+        response["seconds"] = time.perf_counter() - start
+        return response
+
+    def answer_line(self, line):
+        """
+        Compute the response to one line of JSON, as a line of JSON.
+        """
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            response = {"id": None, "error": f"invalid request: {e}"}
+        else:
+            response = self.answer(request)
+        return json.dumps(response, default=repr) + "\n"
+
+
+def serve_stdio(service, infile=sys.stdin, outfile=sys.stdout):
+    """
+    Answer requests read from INFILE, one per line, writing each response to OUTFILE as
+    soon as it is ready, until INFILE is closed.
+    """
+    for line in infile:
+        if line.strip():
+            outfile.write(service.answer_line(line))
+            outfile.flush()
+
+
+async def serve_socket(service, path):
+    """
+    Answer requests from any number of clients connected to a Unix socket at PATH, until
+    the process is stopped. Reading and writing are done for all clients concurrently, but
+    decisions are computed one at a time in a single worker thread, since decide() keeps
+    track of the calls that are currently running.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+
+    async def handle(reader, writer):
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    writer.write((await loop.run_in_executor(executor, service.answer_line, line)).encode())
+                    await writer.drain()
+        finally:
+            writer.close()
+
+    # a socket left behind by an earlier service would stop us from listening
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path)
+    async with server:
+        await server.serve_forever()
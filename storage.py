@@ -0,0 +1,283 @@
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from factorgraph import DeterministicTable, Factor, FactorGraph, PolicySpace, count_vectors
+
+# This file saves tabulated factor graphs to disk and loads them again, so that a large
+# world model only has to be built and tabulated once. A file starts with the bytes
+# "DTFG", a format version and the length of a JSON header, all little-endian. The header
+# lists the nodes with their possible values and the factors with their scopes, and gives
+# the dtype, shape and position in the file of each factor's table. The tables follow the
+# header as raw arrays, each starting at a multiple of ALIGNMENT bytes, so that load() can
+# memory-map them. Processes that load the same file then share the same pages.
+
+MAGIC = b"DTFG"
+VERSION = 1
+ALIGNMENT = 64
+
+# what the function of a loaded deterministic factor returns for causes whose value is not
+# a possible value of the consequence
+_impossible = object()
+
+
+def save(path, world_model, extra=()):
+    """
+    Write WORLD_MODEL to PATH, tabulating any factor that has not been tabulated yet.
+    EXTRA is a list of further values to store alongside it, such as the rest of a
+    decision problem, which load() returns as they were given.
+    """
+    arrays = []
+    factors = []
+    for factor in world_model.factors:
+        entry = {"consequence": factor.consequence, "causes": factor.causes, "array": len(arrays)}
+        if factor.conditional_of_counts is not None:
+            # the full table of a symmetric factor can be far too large to build
+            entry["kind"] = "symmetric"
+            arrays.append(factor.to_count_table(world_model.nodes))
+        else:
+            table = factor.to_table(world_model.nodes)
+            if isinstance(table, DeterministicTable):
+                entry["kind"] = "deterministic"
+                arrays.append(table.codes)
+            else:
+                entry["kind"] = "table"
+                arrays.append(table)
+        factors.append(entry)
+
+    offset = 0
+    layout = []
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        layout.append({"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({
+        "nodes": [[node, _encode(values)] for node, values in world_model.nodes.items()],
+        "factors": factors,
+        "arrays": layout,
+        "extra": _encode(list(extra)),
+    }).encode()
+    start = -(-(len(MAGIC) + 12 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<IQ", VERSION, len(header)) + header)
+        for array, entry in zip(arrays, layout):
+            f.seek(start + entry["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + offset)
+
+
+def load(path):
+    """
+    Read a factor graph written by save(), returning the factor graph and the list of extra
+    values stored with it. The tables are memory-mapped rather than read, and each factor
+    starts out with its table, so its conditional probability never needs to be evaluated.
+    """
+    with open(path, "rb") as f:
+        magic, (version, length) = f.read(len(MAGIC)), struct.unpack("<IQ", f.read(12))
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a saved factor graph")
+        if version != VERSION:
+            raise Exception(f"{path} has format version {version}, expected {VERSION}")
+        header = json.loads(f.read(length))
+    start = -(-(len(MAGIC) + 12 + length) // ALIGNMENT) * ALIGNMENT
+
+    arrays = []
+    for entry in header["arrays"]:
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        size = int(np.prod(shape))
+        if size == 0:
+            arrays.append(np.zeros(shape, dtype=dtype))
+        else:
+            arrays.append(MappedArray(os.path.abspath(path), dtype.str, start + entry["offset"], shape).open())
+
+    nodes = {node: _decode(values) for node, values in header["nodes"]}
+    factors = []
+    for entry in header["factors"]:
+        array = arrays[entry["array"]]
+        consequence, causes = entry["consequence"], entry["causes"]
+        if entry["kind"] == "symmetric":
+            factors.append(_symmetric_factor(nodes, consequence, causes, array))
+        elif entry["kind"] == "deterministic":
+            factors.append(_tabulated_factor(nodes, consequence, causes, DeterministicTable(array, len(nodes[consequence]))))
+        else:
+            factors.append(_tabulated_factor(nodes, consequence, causes, array))
+    return FactorGraph(nodes, factors), _decode(header["extra"])
+
+
+class MappedArray(object):
+    """
+    A description of an array that load() memory-mapped from a file, giving the path, the
+    dtype, the position of the array in the file and its shape. It can be sent to another
+    process far more cheaply than the array itself, and that process can then map the same
+    pages, which the operating system shares between the processes.
+    """
+    __slots__ = ("path", "dtype", "offset", "shape")
+
+    def __init__(self, path, dtype, offset, shape):
+        self.path = path
+        self.dtype = dtype
+        self.offset = offset
+        self.shape = tuple(shape)
+
+    @classmethod
+    def of(cls, array):
+        """
+        Describe ARRAY if it is an array that was memory-mapped by load(), as opposed to a
+        view of part of one or an array held in memory, and otherwise return None.
+        """
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename is not None:
+            return cls(array.filename, array.dtype.str, array.offset, array.shape)
+        return None
+
+    def open(self):
+        """
+        Memory-map the array that this describes.
+        """
+        return np.memmap(self.path, dtype=np.dtype(self.dtype), mode="r", offset=self.offset, shape=self.shape)
+
+
+def shareable(table):
+    """
+    Replace a tabulated factor that load() memory-mapped, or the codes of a deterministic
+    one, by a MappedArray describing it, so that it can be sent to a worker process without
+    copying its contents. Other tables are returned unchanged. See opened().
+    """
+    if isinstance(table, DeterministicTable):
+        described = MappedArray.of(table.codes)
+        return table if described is None else DeterministicTable(described, table.num_values)
+    described = MappedArray.of(table)
+    return table if described is None else described
+
+
+def opened(table):
+    """
+    Undo shareable() in the process that received TABLE, by memory-mapping what it describes.
+    """
+    if isinstance(table, DeterministicTable) and isinstance(table.codes, MappedArray):
+        return DeterministicTable(table.codes.open(), table.num_values)
+    if isinstance(table, MappedArray):
+        return table.open()
+    return table
+
+
+def _tabulated_factor(nodes, consequence, causes, table):
+    """
+    Create a factor whose conditional probability is looked up in TABLE, which is what
+    to_table() would return for it.
+    """
+    scope = causes if consequence is None else [consequence] + causes
+    domains = [nodes[n] for n in scope]
+    positions = [{value: code for code, value in enumerate(values)} for values in domains]
+
+    def conditional(*values):
+        return float(table[tuple(p[v] for p, v in zip(positions, values))])
+
+    function = None
+    if isinstance(table, DeterministicTable):
+        def function(*cause_values):
+            code = table.codes[tuple(p[v] for p, v in zip(positions[1:], cause_values))]
+            return domains[0][code] if code >= 0 else _impossible
+
+    factor = Factor(consequence, causes, conditional, function=function)
+    factor._table = table
+    factor._table_domains = domains
+    return factor
+
+
+def _symmetric_factor(nodes, consequence, causes, count_table):
+    """
+    Create a symmetric factor whose conditional of counts is looked up in COUNT_TABLE, which
+    is what to_count_table() would return for it.
+    """
+    values = nodes[causes[0]] if causes else []
+    consequence_positions = {value: code for code, value in enumerate(nodes[consequence] if consequence is not None
+                                                                      else [None])}
+    columns = {division: i for i, division in enumerate(count_vectors(len(causes), len(values)))}
+
+    def conditional_of_counts(consequence_value, counts):
+        division = tuple(counts.get(value, 0) for value in values)
+        return float(count_table[consequence_positions[consequence_value], columns[division]])
+
+    return Factor.symmetric(consequence, causes, conditional_of_counts)
+
+
+def _encode(value):
+    """
+    Convert a possible value, or a structure containing them, into something JSON can hold
+    without losing its type.
+    """
+    if isinstance(value, PolicySpace):
+        return {"policy_space": [_encode(value.input_space), _encode(value.output_space)]}
+    if isinstance(value, tuple):
+        return {"tuple": [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return {"dict": [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise Exception(f"cannot save {value!r}: expected strings, numbers, tuples, lists or dicts")
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        if "policy_space" in value:
+            return PolicySpace(*(_decode(v) for v in value["policy_space"]))
+        if "tuple" in value:
+            return tuple(_decode(v) for v in value["tuple"])
+        return {_decode(k): _decode(v) for k, v in value["dict"]}
+    return value
+
+
+def definition_hash(build, *args):
+    """
+    Compute a digest that changes whenever the definition of the problem built by calling
+    BUILD(*ARGS) might have changed: the arguments, the source of the module that defines
+    BUILD, and the source of the other modules in the same directory that it uses.
+    """
+    module = inspect.getmodule(build)
+    directory = os.path.dirname(os.path.abspath(inspect.getsourcefile(module)))
+    sources = {inspect.getsourcefile(module)}
+    for value in vars(module).values():
+        used = value if inspect.ismodule(value) else inspect.getmodule(value)
+        try:
+            source = inspect.getsourcefile(used) if used is not None else None
+        except TypeError:
+            continue
+        if source is not None and os.path.dirname(os.path.abspath(source)) == directory:
+            sources.add(source)
+
+    digest = hashlib.sha256(repr((VERSION, build.__qualname__, args)).encode())
+    digest.update(inspect.getsource(build).encode())
+    for source in sorted(sources):
+        with open(source, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cached(build, *args, directory="cache"):
+    """
+    Build a decision problem by calling BUILD(*ARGS), or load it from DIRECTORY if it was
+    saved there by an earlier call with the same definition. The problem is a tuple
+    whose first element is the world model, as returned by the functions in problems.py.
+    """
+    path = os.path.join(directory, definition_hash(build, *args) + ".dtfg")
+    if os.path.exists(path):
+        world_model, extra = load(path)
+        return (world_model, *extra)
+    problem = build(*args)
+    os.makedirs(directory, exist_ok=True)
+    # write to a temporary file first so that a concurrent load never sees half a file
+    temporary = f"{path}.{os.getpid()}"
+    save(temporary, problem[0], problem[1:])
+    os.replace(temporary, path)
+    return problem
+
@@ -1,50 +1,52 @@
 import itertools
 import collections
-from copy import deepcopy
 
-from factorgraph import Factor, FactorGraph
+from factorgraph import Factor, PolicySpace, conditionalize
 import decide
 
 
 def evidential_decision_theory(world_model, observations, utility_node, physical_identity, logical_identity):
     """
-    In evidential decision theory we make no changes to the world model, and directly
-    conidition on the physical_identity node. This makes EDT incredibly trivial to
-    implement in this framework.
+    In evidential decision theory we make no changes to the world model other than
+    conditioning on our observations, and directly conidition on the physical_identity
+    node. This makes EDT incredibly trivial to implement in this framework.
     """
-    return world_model, physical_identity, lambda output: output
+    return conditionalize(world_model, **observations), physical_identity, lambda output: output
 
 
 def causal_decision_theory(world_model, observations, utility_node, physical_identity, logical_identity):
     """
     In causal decision theory we do a surgery in which we drop all factors with the physical_identity
-    as a consequence, and then condition on the physical_identity node.
+    as a consequence, and then condition on our observations and on the physical_identity node.
     """
-    modified_factors = [factor for factor in world_model.factors if factor.consequence != physical_identity]
-    return FactorGraph(world_model.nodes, modified_factors), physical_identity, lambda output: output
+    modified_model = conditionalize(world_model.with_changes(remove_factors=[physical_identity]), **observations)
+    return modified_model, physical_identity, lambda output: output
 
 
 def timeless_decision_theory(world_model, observations, utility_node, physical_identity, logical_identity):
     """
     In timeless decision theory we do a surgery in which we drop all factors with any logical_identity
     node as a consequence, then add a new node with each logical_identity node as a deterministic consequence
-    of it.
+    of it. Finally we condition on our observations.
     """
 
     # add a new node with possible values equal to those of the logical identity nodes
     possible_values = world_model.nodes[logical_identity[0]]
-    modified_nodes = deepcopy(world_model.nodes)
-    modified_nodes["output of my decision algorithm"] = possible_values
-
-    # remove factors that have any logical_identity node as a consequence
-    modified_factors = [factor for factor in world_model.factors if factor.consequence not in logical_identity]
+    added_nodes = {"output of my decision algorithm": possible_values}
 
     # add a factor that makes each logical_identity node a deterministic function of "output of my decision algorithm"
+    added_factors = []
     for n in logical_identity:
-        modified_factors.append(Factor.identical(n, "output of my decision algorithm"))
+        added_factors.append(Factor.identical(n, "output of my decision algorithm"))
+
+    # replace the factors that have any logical_identity node as a consequence, then condition on
+    # what we have observed
+    modified_model = world_model.with_changes(add_nodes=added_nodes, remove_factors=logical_identity,
+                                              add_factors=added_factors)
+    modified_model = conditionalize(modified_model, **observations)
 
     # return the modified factor graph, using the new logical node as the intervention node
-    return FactorGraph(modified_nodes, modified_factors), "output of my decision algorithm", lambda output: output
+    return modified_model, "output of my decision algorithm", lambda output: output
 
 
 def updateless_decision_theory_11(world_model, observations, utility_node, physical_identity, logical_identity):
@@ -83,40 +85,43 @@ def updateless_decision_theory_11(world_model, observations, utility_node, physi
         if set(alt_output_space) != set(output_space):
             raise Exception(f"inconsistent logical outputs: {alt_output_space} vs {output_space} (for {identity})")
 
-    # now do a second cartesian product to make a list of all possible policies
-    policy_space = list(itertools.product(output_space, repeat=len(input_space)))
+    # now do a second cartesian product to get the space of all possible policies, which
+    # generates each policy on demand since there can be very many of them
+    policy_space = PolicySpace(input_space, output_space)
 
     # add a new node with possible values equal to the policy space
-    modified_nodes = deepcopy(world_model.nodes)
-    modified_nodes["my policy"] = policy_space
-
-    # remove factors that have any logical_identity node as a consequence
-    modified_factors = [factor for factor in world_model.factors if factor.consequence not in logical_identity]
+    added_nodes = {"my policy": policy_space}
 
     # add a factor that makes each logical_identity node a function of its original inputs plus "my policy"
+    added_factors = []
     for n in logical_identity:
         original_causes = inputs_by_logical_identity[n]
         modified_causes = ["my policy"] + original_causes
-        modified_factors.append(Factor.deterministic(n, modified_causes,
-                                                     lambda policy, *inputs: policy[input_space.index(inputs)]))
+        added_factors.append(Factor.deterministic(n, modified_causes,
+                                                  lambda policy, *inputs: policy[policy_space.input_index[inputs]]))
 
     # turn the observations dictionary into a tuple of inputs
     output_formatter = lambda output: output
     if all(node in observations for node in input_nodes):
         observed_inputs = tuple(observations[node] for node in input_nodes)
-        output_formatter = lambda policy: policy[input_space.index(observed_inputs)]
+        output_formatter = lambda policy: policy[policy_space.input_index[observed_inputs]]
 
-    # return the modified factor graph, using the new policy node as the intervention node
-    return FactorGraph(modified_nodes, modified_factors), "my policy", output_formatter
+    # replace the factors that have any logical_identity node as a consequence, and return the
+    # modified factor graph, using the new policy node as the intervention node
+    modified_model = world_model.with_changes(add_nodes=added_nodes, remove_factors=logical_identity,
+                                              add_factors=added_factors)
+    return modified_model, "my policy", output_formatter
 
 
 def recursive_decision_theory(world_model, observations, utility_node, physical_identity, logical_identity):
     """
     Naive functional decision theory implements FDT by calling itself recursively for each
     possible counterfactual world, and using the result to put a prior on the node
-    representing its own output in each of those counterfactual worlds. This leads to an
-    infinite recursion, as each of the counterfactual decisions performs the same thing from
-    the perspective of that counterfactual world.
+    representing its own output in each of those counterfactual worlds. Each of the
+    counterfactual decisions performs the same thing from the perspective of that
+    counterfactual world, using the same inference backend, which leads back to the
+    decision we started with. decide() detects this self-reference and resolves it by
+    looking for outputs of all the decisions involved that are consistent with one another.
 
     Here, a counterfactual means each possible value of the nodes that are immediate causes
     of any of the nodes in logical_identity. It is assumed that each logical identity node
@@ -140,14 +145,9 @@ def recursive_decision_theory(world_model, observations, utility_node, physical_
 
     # add nodes for each possible world: this includes the "actual" world as well as all counterfactuals
     added_nodes = []
-    modified_nodes = deepcopy(world_model.nodes)
     for inputs in input_space:
         node_name = f"my decision given {inputs}"
         added_nodes.append(node_name)
-        modified_nodes[node_name] = output_space
-
-    # remove factors that have any logical_identity node as a consequence
-    modified_factors = [factor for factor in world_model.factors if factor.consequence not in logical_identity]
 
     # define a function that looks up the value of one of the self-referential nodes, given
     # a tuple of concrete inputs
@@ -157,16 +157,20 @@ def recursive_decision_theory(world_model, observations, utility_node, physical_
         return logical_outputs[index]
 
     # add a factor that makes each logical_identity node a function of its original inputs plus each of the added nodes
+    added_factors = []
     for node_name in logical_identity:
         original_causes = inputs_by_logical_identity[node_name]
         modified_causes = added_nodes + original_causes
-        modified_factors.append(Factor.deterministic(
+        added_factors.append(Factor.deterministic(
             node_name,
             modified_causes,
             lambda *args: lookup_logical_output_given_inputs(args[:len(added_nodes)], args[len(added_nodes):])))
 
     # work out which of the added nodes corresponds to the "actual" world: this should match one of the
     # nodes added above
+    if not all(node in observations for node in input_nodes):
+        raise decide.ObservationRequired(f"recursive decision theory requires the inputs {input_nodes} "
+                                         f"to be observed")
     observed_inputs = tuple(observations[node] for node in input_nodes)
     node_name_for_observed_inputs = f"my decision given {observed_inputs}"
 
@@ -174,8 +178,34 @@ def recursive_decision_theory(world_model, observations, utility_node, physical_
     for inputs in input_space:
         if inputs != observed_inputs:
             counterfactual_node_name = f"my decision given {inputs}"
-            counterfactual_output = decide.decide(recursive_decision_theory, world_model, observations, utility_node,  physical_identity, logical_identity)
-            modified_factors.append(Factor.indicator(counterfactual_node_name, counterfactual_output))
-
-    # return the modified factor graph, using the new policy node as the intervention node
-    return FactorGraph(modified_nodes, modified_factors), node_name_for_observed_inputs, lambda output: output
+            counterfactual_observations = {**observations, **dict(zip(input_nodes, inputs))}
+            _, counterfactual_output = decide.decide_counterfactual(recursive_decision_theory, world_model,
+                                                                    counterfactual_observations, utility_node,
+                                                                    physical_identity, logical_identity)
+            added_factors.append(Factor.indicator(counterfactual_node_name, counterfactual_output))
+
+    # replace the factors that have any logical_identity node as a consequence, and return the
+    # modified factor graph, using the node for the observed inputs as the intervention node
+    modified_model = world_model.with_changes(add_nodes={node: output_space for node in added_nodes},
+                                              remove_factors=logical_identity, add_factors=added_factors)
+    return modified_model, node_name_for_observed_inputs, lambda output: output
+
+
+# how the surgery of each theory uses the observations, which lets decide_all_observations()
+# answer every assignment of the observed nodes from the graph the theory builds with
+# nothing observed: "conditioned" if the surgery conditions that graph on them, and
+# "unchanged" if only the output formatter depends on them. RDT cannot build that graph.
+evidential_decision_theory.surgery_given_observations = "conditioned"
+causal_decision_theory.surgery_given_observations = "conditioned"
+timeless_decision_theory.surgery_given_observations = "conditioned"
+updateless_decision_theory_11.surgery_given_observations = "unchanged"
+
+
+# the decision theories in this file, by the names used on the command line
+THEORIES = {
+    "EDT": evidential_decision_theory,
+    "CDT": causal_decision_theory,
+    "TDT": timeless_decision_theory,
+    "UDT1.1": updateless_decision_theory_11,
+    "RDT": recursive_decision_theory,
+}